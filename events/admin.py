@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.apps import apps
 
 from events import models
+from events.services import EventpointsService, EventService, RatingService
 
 # Register your models here.
 
@@ -11,12 +12,24 @@ class CategoryAdmin(admin.ModelAdmin):
     exclude = ()
 
 
+class DataExportAdmin(admin.ModelAdmin):
+    search_fields = ('user__username',)
+    list_display = ('user', 'status', 'created_at', 'finished_at')
+    list_filter = ('status',)
+
+
 class EnrollmentAdmin(admin.ModelAdmin):
     search_fields = ('created_by__username', 'event__title')
     list_display = ('status', 'created_by', 'event')
     list_filter = (
         'status', ('created_by', admin.RelatedOnlyFieldListFilter), ('event__created_by', admin.RelatedOnlyFieldListFilter))
 
+    def save_model(self, request, obj, form, change):
+        super(EnrollmentAdmin, self).save_model(request, obj, form, change)
+        events = [obj.event_id, form.initial.get('event')]
+        EventService().reconcile_accepted_counts(
+            models.Event.objects.filter(pk__in=[pk for pk in events if pk is not None]))
+
 
 class EventAdmin(admin.ModelAdmin):
     search_fields = ('title', 'category__name', 'created_by__username')
@@ -27,15 +40,43 @@ class EventAdmin(admin.ModelAdmin):
                    'price', 'capacity', 'lang', 'min_age')
 
 
+class EventpointsEntryAdmin(admin.ModelAdmin):
+    search_fields = ('user__username',)
+    list_display = ('user', 'points', 'reason', 'transaction_id', 'created_at')
+    list_filter = ('reason',)
+    raw_id_fields = ('user', 'transaction')
+
+    def save_model(self, request, obj, form, change):
+        super(EventpointsEntryAdmin, self).save_model(request, obj, form, change)
+        users = [obj.user_id, form.initial.get('user')]
+        EventpointsService().reconcile(
+            models.Profile.objects.filter(user__in=[pk for pk in users if pk is not None]))
+
+
 class MessageAdmin(admin.ModelAdmin):
     search_fields = ('title',)
     list_display = ('title',)
 
 
+class OutboxEmailAdmin(admin.ModelAdmin):
+    search_fields = ('recipient', 'subject')
+    list_display = ('subject', 'recipient', 'created_at',
+                    'sent_at', 'attempts', 'next_attempt_at')
+    list_filter = ('sent_at',)
+
+
 class ProfileAdmin(admin.ModelAdmin):
     search_fields = ('user__username', 'token')
     list_display = ('user', 'birthdate', 'age', 'token',
                     'eventpoints', 'discount', 'avg_attendee_score', 'avg_host_score')
+    # moved only through eventpoints entries
+    readonly_fields = ('eventpoints',)
+
+
+class StripeEventAdmin(admin.ModelAdmin):
+    search_fields = ('id', 'type')
+    list_display = ('id', 'type', 'received_at', 'processed_at', 'attempts', 'next_attempt_at')
+    list_filter = ('type', 'processed_at')
 
 
 class RatingAdmin(admin.ModelAdmin):
@@ -44,10 +85,20 @@ class RatingAdmin(admin.ModelAdmin):
     list_filter = ('score', ('created_by', admin.RelatedOnlyFieldListFilter),
                    ('reviewed', admin.RelatedOnlyFieldListFilter))
 
+    def save_model(self, request, obj, form, change):
+        super(RatingAdmin, self).save_model(request, obj, form, change)
+        reviewed = [obj.reviewed_id, form.initial.get('reviewed')]
+        RatingService().rebuild_scores(
+            [pk for pk in reviewed if pk is not None])
+
 
 admin.site.register(models.Category, CategoryAdmin)
+admin.site.register(models.DataExport, DataExportAdmin)
 admin.site.register(models.Enrollment, EnrollmentAdmin)
 admin.site.register(models.Event, EventAdmin)
+admin.site.register(models.EventpointsEntry, EventpointsEntryAdmin)
 admin.site.register(models.Message, MessageAdmin)
+admin.site.register(models.OutboxEmail, OutboxEmailAdmin)
 admin.site.register(models.Profile, ProfileAdmin)
 admin.site.register(models.Rating, RatingAdmin)
+admin.site.register(models.StripeEvent, StripeEventAdmin)
@@ -1,5 +1,11 @@
+import googlemaps
+import hashlib
+
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth import get_user_model
+from django.core.files.storage import get_storage_class
+from django.utils.module_loading import import_string
 
 from storages.backends.s3boto3 import S3Boto3Storage
 
@@ -31,3 +37,46 @@ class MediaStorageBackend(S3Boto3Storage):
     location = 'media'
     default_acl = 'public-read'
     file_overwrite = False
+
+
+class PrivateMediaStorageBackend(S3Boto3Storage):
+    location = 'private'
+    default_acl = 'private'
+    file_overwrite = True
+
+
+class GoogleGeocoderBackend:
+    def geocode(self, address: str):
+        try:
+            gmaps = googlemaps.Client(key=settings.GOOGLE_API_KEY)
+            results = gmaps.geocode(address, region='es')
+        except (ValueError, googlemaps.exceptions.ApiError, googlemaps.exceptions.Timeout,
+                googlemaps.exceptions.TransportError):
+            return None
+
+        if not results:
+            return None
+        location = results[0]['geometry']['location']
+        return location['lat'], location['lng']
+
+
+class LocalGeocoderBackend:
+    # stand-in for tests and offline seeding: every address is placed
+    # deterministically within ~0.25 degrees of the origin
+    ORIGIN = (37.3891, -5.9845)
+    SPREAD = 0.25
+
+    def geocode(self, address: str):
+        digest = hashlib.md5(address.lower().encode('utf-8')).digest()
+        lat_offset = int.from_bytes(digest[:4], 'big') / 0xFFFFFFFF
+        lng_offset = int.from_bytes(digest[4:8], 'big') / 0xFFFFFFFF
+        return (self.ORIGIN[0] + (lat_offset * 2 - 1) * self.SPREAD,
+                self.ORIGIN[1] + (lng_offset * 2 - 1) * self.SPREAD)
+
+
+def get_geocoder():
+    return import_string(settings.GEOCODER_BACKEND)()
+
+
+def get_export_storage():
+    return get_storage_class(settings.EXPORT_FILE_STORAGE)()
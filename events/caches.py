@@ -0,0 +1,43 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+class LocalCache:
+    # a value kept in the process, reloaded when the version shared through the
+    # cache changes, which is checked at most once every interval seconds
+    def __init__(self, key: str, interval: int):
+        self.key = key
+        self.interval = interval
+        self.value = None
+        self.version = None
+        self.checked = None
+
+    def get(self, load):
+        now = time.monotonic()
+        if self.checked is None or now - self.checked >= self.interval:
+            version = cache.get_or_set(self.key, time.time_ns, None)
+            if version != self.version:
+                self.value, self.version = load(), version
+            self.checked = now
+        return self.value
+
+    def expire(self, using=None):
+        # a process reloading before the commit would keep the old rows until the next change
+        transaction.on_commit(self.expire_now, using)
+
+    def expire_now(self):
+        try:
+            cache.incr(self.key)
+        except ValueError:
+            # a fresh version is set on the next get
+            pass
+        self.checked = None
+
+
+# the announcement banner of the home page
+last_message = LocalCache('events:message:version', 30)
+
+# the cities of the location autocomplete, see events.cities
+city_index = LocalCache('events:cities:version', 30)
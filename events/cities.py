@@ -0,0 +1,37 @@
+import bisect
+import unicodedata
+
+from itertools import islice
+
+NO_CITY = 'No disponible'
+
+
+def fold(text: str) -> str:
+    # lowercase without accents, 'Écija' and 'ecija' index the same
+    text = unicodedata.normalize('NFKD', text)
+    return ' '.join(''.join(char for char in text if not unicodedata.combining(char)).lower().split())
+
+
+class CityIndex:
+    def __init__(self, counts=()):
+        # number of events in every city, and the cities sorted by their folded name
+        self.counts = dict(counts)
+        self.keys = sorted((fold(city), city) for city in self.counts)
+
+    def __iter__(self):
+        return (city for key, city in self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def complete(self, prefix: str, limit: int = 10) -> list:
+        prefix = fold(prefix)
+        start = bisect.bisect_left(self.keys, (prefix,))
+        matches = []
+        for key, city in islice(self.keys, start, None):
+            if not key.startswith(prefix):
+                break
+            matches.append(city)
+        # the cities with more events first
+        return sorted(matches, key=lambda city: -self.counts[city])[:limit]
+
@@ -356,11 +356,17 @@ class ProfileForm(forms.ModelForm):
         profile = super(ProfileForm, self).save(commit=False)
         if user:
             profile.user = user
-        profile.save()
+        if profile.pk is None:
+            profile.save()
+        else:
+            # the eventpoints and the rating scores are moved with relative updates, never written back
+            profile.save(update_fields=list(self.fields))
         return profile
 
 
 class SearchHomeForm(forms.Form):
+    search = forms.CharField(required=False, max_length=100, widget=forms.TextInput(
+        attrs={'placeholder': "Cata, juegos de mesa..."}))
     location = forms.CharField(required=False, widget=forms.TextInput(
         attrs={'placeholder': "Localidad", 'class': "input-field autocomplete ", 'id': "autocomplete-input"}))
     date = forms.DateField(
@@ -398,6 +404,8 @@ class SearchHomeForm(forms.Form):
 
 
 class SearchFilterForm(forms.Form):
+    search = forms.CharField(required=False, max_length=100, widget=forms.TextInput(
+        attrs={'placeholder': "Cata, juegos de mesa..."}))
     location = forms.CharField(required=False, widget=forms.TextInput(
         attrs={'placeholder': "Localidad", 'class': "autocomplete input-field", 'id': "autocomplete-input"}))
     date = forms.DateField(
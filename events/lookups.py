@@ -0,0 +1,21 @@
+from django.contrib.postgres.search import SearchQuery
+from django.db.models import CharField, Transform
+
+
+class ImmutableUnaccent(Transform):
+    # unaccent is only STABLE, f_unaccent (migration 0011) wraps it as IMMUTABLE
+    # so the trigram index on f_unaccent(location_city) can serve the lookup
+    lookup_name = 'immutable_unaccent'
+    function = 'F_UNACCENT'
+
+
+class UnaccentSearchQuery(SearchQuery):
+    # Event.search_vector is built from f_unaccent'ed text, the query must be too
+    def as_sql(self, compiler, connection):
+        config_sql, config_params = compiler.compile(self.config)
+        template = '{0}({1}::regconfig, F_UNACCENT(%s))'.format(
+            self.SEARCH_TYPES[self.search_type], config_sql)
+        return template, config_params + [self.value]
+
+
+CharField.register_lookup(ImmutableUnaccent)
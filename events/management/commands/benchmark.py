@@ -0,0 +1,266 @@
+import copy
+import json
+import math
+import os
+import random
+import tracemalloc
+
+from types import SimpleNamespace
+from unittest import mock
+
+import stripe
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction as db_transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
+
+from events import models
+from events import selectors
+from events import services
+from events.middleware import RequestMetrics
+from scripts.seed import seed_large
+
+User = get_user_model()
+
+SEARCH_FILTERS = [
+    {},
+    {'location_city__immutable_unaccent__trigram_similar': 'Sevilla'},
+    {'price__lte': 10},
+    {'category': 1, 'price__gte': 8},
+]
+
+
+class FakeCustomer:
+    @staticmethod
+    def create(**kwargs):
+        return SimpleNamespace(id='cus_{0:014x}'.format(random.getrandbits(56)))
+
+    @staticmethod
+    def list(**kwargs):
+        return SimpleNamespace(data=[], auto_paging_iter=lambda: iter([]))
+
+
+class FakeCharge:
+    @staticmethod
+    def create(**kwargs):
+        return SimpleNamespace(id='ch_{0:014x}'.format(random.getrandbits(56)))
+
+
+class Command(BaseCommand):
+    help = ('Seeds synthetic datasets of several sizes and times the search, detail and enrollment hot paths. '
+            'The database is flushed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                            help='Number of events of every dataset')
+        parser.add_argument('--iterations', type=int, default=30)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--skip-seed', action='store_true',
+                            help='Benchmark the data already loaded, only with a single size')
+        parser.add_argument('--baseline', default='benchmark_baseline.json')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Store the results as the new baseline instead of comparing against it')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed slowdown of p95 and peak memory over the baseline, 0.5 is 50%%')
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive')
+
+    def handle(self, *args, **options):
+        if options['skip_seed'] and len(options['sizes']) > 1:
+            raise CommandError('--skip-seed benchmarks the loaded data, pass a single size')
+        if not options['skip_seed'] and options['interactive']:
+            answer = input('This will flush the {0} database. Type yes to continue: '.format(
+                settings.DATABASES['default']['NAME']))
+            if answer != 'yes':
+                raise CommandError('Benchmark cancelled')
+
+        results = {}
+        with override_settings(GEOCODER_BACKEND='events.backends.LocalGeocoderBackend', ALLOWED_HOSTS=['*']), \
+                mock.patch.object(stripe, 'Customer', FakeCustomer), \
+                mock.patch.object(stripe, 'Charge', FakeCharge):
+            for size in options['sizes']:
+                if not options['skip_seed']:
+                    self.stdout.write('Seeding {0} events'.format(size))
+                    seed_large(users=max(size // 10, 100), events=size, enrollments=size * 5,
+                               ratings=size, transactions=size * 3, seed=options['seed'])
+                results[str(size)] = Benchmark(options['seed'], options['iterations']).run()
+                self.report(size, results[str(size)])
+
+        if options['save_baseline']:
+            with open(options['baseline'], 'w') as file:
+                file.write(json.dumps(results, indent=4))
+            self.stdout.write('Baseline stored in {0}'.format(options['baseline']))
+        elif os.path.exists(options['baseline']):
+            with open(options['baseline']) as file:
+                regressions = self.compare(results, json.load(file), options['tolerance'])
+            if regressions:
+                raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+        else:
+            self.stdout.write('No baseline found in {0}, run with --save-baseline to store one'.format(
+                options['baseline']))
+
+    def report(self, size, cases):
+        self.stdout.write('\n{0} events'.format(size))
+        self.stdout.write('{0:<24}{1:>10}{2:>10}{3:>10}{4:>12}'.format(
+            'case', 'p50 ms', 'p95 ms', 'queries', 'peak KiB'))
+        for name, result in cases.items():
+            self.stdout.write('{0:<24}{1:>10.1f}{2:>10.1f}{3:>10}{4:>12.0f}'.format(
+                name, result['p50'], result['p95'], result['queries'], result['peak_kib']))
+
+    def compare(self, results, baseline, tolerance):
+        regressions = []
+        for size, cases in results.items():
+            for name, result in cases.items():
+                expected = baseline.get(size, {}).get(name)
+                if expected is None:
+                    continue
+                if result['queries'] > expected['queries']:
+                    regressions.append('{0} events, {1}: {2} queries, baseline {3}'.format(
+                        size, name, result['queries'], expected['queries']))
+                for metric in ('p95', 'peak_kib'):
+                    if result[metric] > expected[metric] * (1 + tolerance):
+                        regressions.append('{0} events, {1}: {2} {3:.1f}, baseline {4:.1f}'.format(
+                            size, name, metric, result[metric], expected[metric]))
+        return regressions
+
+
+class Benchmark:
+    def __init__(self, seed, iterations):
+        self.random = random.Random(seed)
+        self.iterations = iterations
+        today = now().date()
+        self.attendees = self.sample(User.objects.filter(is_superuser=False))
+        self.upcoming = self.sample(models.Event.objects.filter(start_day__gt=today))
+        self.finished = self.sample(models.Event.objects.filter(
+            start_day__lt=today, event_transaction__isnull=False).distinct())
+
+    def sample(self, queryset, size=200) -> list:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+        return self.random.sample(pks, min(size, len(pks)))
+
+    def run(self) -> dict:
+        cases = {
+            'events_filter_search': self.events_filter_search,
+            'base_search_events': self.base_search_events,
+            'event_filter_list_view': self.event_filter_list_view,
+            'home_view': self.home_view,
+            'event_detail_view': self.event_detail_view,
+            'enrollment_create_post': self.enrollment_create_post,
+            'return_eventpoints': self.return_eventpoints,
+            'return_eventpoints_host': self.return_eventpoints_host,
+        }
+        return {name: self.measure(case) for name, case in cases.items()}
+
+    def measure(self, case) -> dict:
+        timings = []
+        queries = 0
+        with db_transaction.atomic():
+            # warm up connections, templates and caches
+            case()()
+            db_transaction.set_rollback(True)
+
+        for _ in range(self.iterations):
+            with db_transaction.atomic():
+                timed = case()
+                metrics = RequestMetrics()
+                with metrics.collect():
+                    timed()
+                db_transaction.set_rollback(True)
+            timings.append(metrics.total_time * 1000)
+            queries = max(queries, metrics.queries)
+            if metrics.http_calls:
+                raise CommandError('{0} called external services'.format(case.__name__))
+
+        # measured apart, tracing allocations slows the timed runs down
+        with db_transaction.atomic():
+            timed = case()
+            tracemalloc.start()
+            timed()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            db_transaction.set_rollback(True)
+
+        return {'p50': percentile(timings, 50), 'p95': percentile(timings, 95),
+                'queries': queries, 'peak_kib': peak / 1024}
+
+    # every case prepares its arguments untimed and returns the call to time
+
+    def attendee(self) -> User:
+        return User.objects.select_related('profile').get(pk=self.random.choice(self.attendees))
+
+    def client(self, user) -> Client:
+        client = Client()
+        client.force_login(user)
+        return client
+
+    def events_filter_search(self):
+        user = self.attendee()
+        filters = self.random.choice(SEARCH_FILTERS)
+        return lambda: list(selectors.EventSelector().events_filter_search(
+            user, **filters).order_by('starts_at')[:12])
+
+    def base_search_events(self):
+        user = self.attendee()
+        return lambda: list(selectors.EventSelector().base_search_events(user).order_by('starts_at')[:12])
+
+    def event_filter_list_view(self):
+        client = self.client(self.attendee())
+        url = reverse('list_event_filter', kwargs={'location': 'Sevilla'} if self.random.random() < 0.5 else {})
+        return lambda: client.get(url)
+
+    def home_view(self):
+        client = self.client(self.attendee())
+        url = reverse('home')
+        return lambda: client.get(url)
+
+    def event_detail_view(self):
+        client = self.client(self.attendee())
+        url = reverse('detail_event', kwargs={'pk': self.random.choice(self.upcoming)})
+        return lambda: client.get(url)
+
+    def enrollment_create_post(self):
+        client = self.client(self.attendee())
+        event_pk = self.random.choice(self.upcoming)
+        # the detail page leaves the fees in the session
+        client.get(reverse('detail_event', kwargs={'pk': event_pk}))
+        url = reverse('enroll_event', kwargs={'pk': event_pk})
+        return lambda: client.post(url, {'stripeToken': 'tok_visa'})
+
+    def return_eventpoints(self):
+        event = models.Event.objects.get(pk=self.random.choice(self.finished))
+        attendees = selectors.UserSelector().event_enrolled(event)
+        return lambda: services.UserService().return_eventpoints(attendees, event)
+
+    def return_eventpoints_host(self):
+        # a host with 500 upcoming events deleting the account, as UserDeleteView refunds it
+        host = User.objects.get(pk=self.random.choice(self.attendees))
+        attendees = User.objects.filter(pk__in=self.random.sample(
+            [pk for pk in self.attendees if pk != host.pk], 5))
+        template = models.Event.objects.get(pk=self.random.choice(self.upcoming))
+        events = []
+        for _ in range(500):
+            event = copy.copy(template)
+            event.pk, event.created_by = None, host
+            events.append(event)
+        events = models.Event.objects.bulk_create(events)
+        models.Enrollment.objects.bulk_create(
+            models.Enrollment(event=event, created_by=attendee, status='ACCEPTED')
+            for event in events for attendee in attendees)
+        models.Transaction.objects.bulk_create(
+            models.Transaction(event=event, created_by=attendee, recipient=host, amount=1000,
+                               discount=self.random.randint(0, 200), fee=150, customer_id='cus_benchmark',
+                               is_paid_for=False)
+            for event in events for attendee in attendees)
+
+        events = selectors.EventSelector().hosted(host).filter(pk__in=[event.pk for event in events])
+        enrolled = selectors.UserSelector().events_enrolleds(events)
+        return lambda: services.UserService().return_eventpoints(enrolled, events)
+
+
+def percentile(values, percent) -> float:
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
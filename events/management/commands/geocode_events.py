@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from events import models
+
+
+class Command(BaseCommand):
+    help = 'Stores coordinates for the events that have not been geocoded yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Geocode every event again, not only the missing ones')
+
+    def handle(self, *args, **options):
+        events = models.Event.objects.exclude(location_city='No disponible')
+        if not options['all']:
+            events = events.filter(latitude__isnull=True)
+
+        geocoded = 0
+        for event in events.iterator():
+            event.geocode()
+            if event.latitude is not None:
+                models.Event.objects.filter(pk=event.pk).update(
+                    latitude=event.latitude, longitude=event.longitude)
+                geocoded += 1
+
+        self.stdout.write('{0} events geocoded'.format(geocoded))
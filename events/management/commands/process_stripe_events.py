@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from events.services import StripeEventService
+
+
+class Command(BaseCommand):
+    help = 'Applies the Stripe webhook events stored in the inbox to the transactions and profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling the inbox instead of exiting once it is drained')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait between polls when the inbox is empty')
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            batch = StripeEventService().process_inbox(options['batch_size'])
+            processed += batch
+            if not batch:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write('{0} Stripe events processed'.format(processed))
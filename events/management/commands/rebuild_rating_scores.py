@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from events.services import RatingService
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the rating counts and sums stored on every profile'
+
+    def handle(self, *args, **options):
+        updated = RatingService().rebuild_scores()
+        self.stdout.write('{0} profiles updated'.format(updated))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from events.services import EventService
+
+
+class Command(BaseCommand):
+    help = 'Repairs the stored accepted attendee count of the events that drifted from their enrollments'
+
+    def handle(self, *args, **options):
+        repaired = EventService().reconcile_accepted_counts()
+        self.stdout.write('{0} events repaired'.format(repaired))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from events.services import EventpointsService
+
+
+class Command(BaseCommand):
+    help = 'Repairs the stored eventpoints of the profiles that drifted from their eventpoints entries'
+
+    def handle(self, *args, **options):
+        repaired = EventpointsService().reconcile()
+        self.stdout.write('{0} profiles repaired'.format(repaired))
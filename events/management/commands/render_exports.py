@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from events.services import ExportService
+
+
+class Command(BaseCommand):
+    help = 'Renders the pending profile data exports into PDF files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling for new exports instead of exiting once they are rendered')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait between polls when there is nothing to render')
+
+    def handle(self, *args, **options):
+        rendered = 0
+        while True:
+            batch = ExportService().render_pending(options['batch_size'])
+            rendered += batch
+            if not batch:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write('{0} exports rendered'.format(rendered))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from events.services import EmailService
+
+
+class Command(BaseCommand):
+    help = 'Delivers the queued outbox emails in batches over a single SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling the outbox instead of exiting once it is drained')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait between polls when the outbox is empty')
+
+    def handle(self, *args, **options):
+        delivered = 0
+        while True:
+            batch = EmailService().deliver_outbox(options['batch_size'])
+            delivered += batch
+            if not batch:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write('{0} emails processed'.format(delivered))
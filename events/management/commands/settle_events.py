@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from events.services import SettlementService
+
+
+class Command(BaseCommand):
+    help = 'Pays out the finished events to their hosts in batches, continuing from the last checkpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Events paid out at the same time')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling for finished events instead of exiting after a full pass')
+        parser.add_argument('--interval', type=float, default=60,
+                            help='Seconds to wait between passes')
+
+    def handle(self, *args, **options):
+        service = SettlementService()
+        settled = failed = skipped = 0
+        while True:
+            events = service.claim(options['batch_size'])
+            if events:
+                batch_settled, batch_failed, batch_skipped = service.settle(events, options['workers'])
+                settled += batch_settled
+                failed += batch_failed
+                skipped += batch_skipped
+            else:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write('{0} events settled, {1} failed, {2} held by another payout'.format(
+            settled, failed, skipped))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from events.services import PaymentService
+
+
+class Command(BaseCommand):
+    help = 'Links the profiles without a known Stripe customer to the existing customers with their email'
+
+    def handle(self, *args, **options):
+        linked = PaymentService().sync_customers()
+        self.stdout.write('{0} profiles linked'.format(linked))
@@ -0,0 +1,103 @@
+import json
+import logging
+import time
+
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+import requests
+
+from django.db import connections
+
+logger = logging.getLogger('events.metrics')
+
+# every metrics being collected, a request made by the benchmark is counted by both
+_active_metrics = ContextVar('active_metrics', default=())
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.view_name = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.http_calls = 0
+        self.http_time = 0.0
+        self.total_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+    @contextmanager
+    def collect(self):
+        _instrument_requests()
+        token = _active_metrics.set(_active_metrics.get() + (self,))
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self))
+                yield self
+        finally:
+            self.total_time += time.perf_counter() - start
+            _active_metrics.reset(token)
+
+    def as_dict(self) -> dict:
+        return {
+            'view': self.view_name,
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 1),
+            'http_calls': self.http_calls,
+            'http_ms': round(self.http_time * 1000, 1),
+            'total_ms': round(self.total_time * 1000, 1),
+        }
+
+    def server_timing(self) -> str:
+        return 'db;dur={0:.1f};desc="{1} queries", http;dur={2:.1f};desc="{3} calls", total;dur={4:.1f}'.format(
+            self.db_time * 1000, self.queries, self.http_time * 1000, self.http_calls, self.total_time * 1000)
+
+
+def _instrument_requests():
+    # Stripe and Google Maps both talk HTTP through requests sessions
+    send = requests.Session.send
+    if getattr(send, 'instrumented', False):
+        return
+
+    def instrumented_send(session, request, **kwargs):
+        active = _active_metrics.get()
+        if not active:
+            return send(session, request, **kwargs)
+        start = time.perf_counter()
+        try:
+            return send(session, request, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            for metrics in active:
+                metrics.http_calls += 1
+                metrics.http_time += elapsed
+
+    instrumented_send.instrumented = True
+    requests.Session.send = instrumented_send
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        _instrument_requests()
+
+    def __call__(self, request):
+        request.metrics = RequestMetrics()
+        with request.metrics.collect():
+            response = self.get_response(request)
+
+        if request.resolver_match is not None:
+            request.metrics.view_name = request.resolver_match.view_name
+        response['Server-Timing'] = request.metrics.server_timing()
+        logger.info(json.dumps(
+            dict(request.metrics.as_dict(), method=request.method, path=request.path, status=response.status_code)))
+        return response
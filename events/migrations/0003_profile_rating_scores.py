@@ -0,0 +1,52 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:53
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def compute_rating_scores(apps, schema_editor):
+    Profile = apps.get_model('events', 'Profile')
+    Rating = apps.get_model('events', 'Rating')
+
+    scores = {}
+    for on in ('ATTENDEE', 'HOST'):
+        ratings = Rating.objects.filter(
+            reviewed=OuterRef('user'), on=on).order_by().values('reviewed')
+        scores[on.lower() + '_rating_count'] = Coalesce(Subquery(
+            ratings.annotate(total=Count('pk')).values('total')), 0)
+        scores[on.lower() + '_rating_sum'] = Coalesce(Subquery(
+            ratings.annotate(total=Sum('score')).values('total')), 0)
+    Profile.objects.update(**scores)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0002_event_coordinates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='attendee_rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Attendee ratings'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='attendee_rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Attendee ratings score'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='host_rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Host ratings'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='host_rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Host ratings score'),
+        ),
+        migrations.RunPython(compute_rating_scores,
+                             migrations.RunPython.noop),
+    ]
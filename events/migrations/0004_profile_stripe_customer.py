@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0003_profile_rating_scores'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='stripe_customer_id',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=250, null=True, verbose_name='stripe_customer_id'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0004_profile_stripe_customer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='charge_id',
+            field=models.CharField(blank=True, editable=False, max_length=250, null=True, verbose_name='Charge_id'),
+        ),
+    ]
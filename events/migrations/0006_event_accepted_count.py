@@ -0,0 +1,32 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:56
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_accepted_enrollments(apps, schema_editor):
+    Enrollment = apps.get_model('events', 'Enrollment')
+    Event = apps.get_model('events', 'Event')
+
+    accepted = Enrollment.objects.filter(
+        event=OuterRef('pk'), status='ACCEPTED').order_by().values('event')
+    Event.objects.update(accepted_count=Coalesce(Subquery(
+        accepted.annotate(total=Count('pk')).values('total')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0005_transaction_charge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='accepted_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Accepted attendees'),
+        ),
+        migrations.RunPython(count_accepted_enrollments,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:57
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def remove_duplicate_enrollments(apps, schema_editor):
+    Enrollment = apps.get_model('events', 'Enrollment')
+    Event = apps.get_model('events', 'Event')
+
+    duplicated = Enrollment.objects.values('event', 'created_by').annotate(
+        total=Count('pk')).filter(total__gt=1)
+    for duplicate in duplicated:
+        # keeps the accepted enrollment if there is one, the newest otherwise
+        enrollments = Enrollment.objects.filter(
+            event=duplicate['event'], created_by=duplicate['created_by'])
+        kept = sorted(enrollments, key=lambda enrollment: (
+            enrollment.status == 'ACCEPTED', enrollment.created_at))[-1]
+        enrollments.exclude(pk=kept.pk).delete()
+
+    accepted = Enrollment.objects.filter(
+        event=OuterRef('pk'), status='ACCEPTED').order_by().values('event')
+    Event.objects.update(accepted_count=Coalesce(Subquery(
+        accepted.annotate(total=Count('pk')).values('total')), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0006_event_accepted_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_enrollments,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='enrollment',
+            constraint=models.UniqueConstraint(fields=('event', 'created_by'), name='unique_enrollment_per_attendee'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:58
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0007_enrollment_unique_attendee'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=250, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('recipient', models.EmailField(max_length=254, verbose_name='Recipient')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Created at')),
+                ('sent_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Sent at')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Attempts')),
+                ('next_attempt_at', models.DateTimeField(blank=True, default=django.utils.timezone.now, editable=False, null=True, verbose_name='Next attempt at')),
+                ('last_error', models.TextField(blank=True, editable=False, null=True, verbose_name='Last error')),
+            ],
+            options={
+                'verbose_name': 'Outbox email',
+                'verbose_name_plural': 'Outbox emails',
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxemail',
+            index=models.Index(condition=models.Q(sent_at__isnull=True), fields=['next_attempt_at'], name='events_outbox_pending_idx'),
+        ),
+    ]
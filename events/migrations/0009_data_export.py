@@ -0,0 +1,42 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('events', '0008_outbox_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataExport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.CharField(max_length=40, verbose_name='Data version')),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=8, verbose_name='Status')),
+                ('file_name', models.CharField(blank=True, editable=False, max_length=250, null=True, verbose_name='File name')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Created at')),
+                ('finished_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Finished at')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data_exports', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Data export',
+                'verbose_name_plural': 'Data exports',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dataexport',
+            index=models.Index(condition=models.Q(status='PENDING'), fields=['created_at'], name='events_export_pending_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dataexport',
+            constraint=models.UniqueConstraint(fields=('user', 'version'), name='unique_data_export_version'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.0.7 on 2026-10-18 12:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_event_timestamps(apps, schema_editor):
+    # the local wall clock time of the event, as Event.timestamps() computes it
+    schema_editor.execute(
+        'UPDATE events_event SET '
+        'starts_at = (start_day + start_time) AT TIME ZONE %s, '
+        'ends_at = (start_day + end_time) AT TIME ZONE %s',
+        [settings.TIME_ZONE, settings.TIME_ZONE])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0009_data_export'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='Starts at'),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='Ends at'),
+        ),
+        migrations.RunPython(set_event_timestamps,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='event',
+            name='starts_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, verbose_name='Starts at'),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, verbose_name='Ends at'),
+        ),
+    ]
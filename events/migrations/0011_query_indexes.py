@@ -0,0 +1,62 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:10
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE/DROP INDEX CONCURRENTLY can not run inside a transaction, the
+    # tables stay writable while the indexes are built on a live database
+    atomic = False
+
+    dependencies = [
+        ('events', '0010_event_timestamps'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS "
+            "$$ SELECT public.unaccent('public.unaccent', $1) $$ "
+            "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT",
+            'DROP FUNCTION IF EXISTS f_unaccent(text)'),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS events_event_city_trgm_idx '
+            'ON events_event USING gin (f_unaccent(location_city) gin_trgm_ops)',
+            'DROP INDEX CONCURRENTLY IF EXISTS events_event_city_trgm_idx'),
+        RemoveIndexConcurrently(
+            model_name='event',
+            name='events_even_locatio_1c6d68_idx',
+        ),
+        AddIndexConcurrently(
+            model_name='enrollment',
+            index=models.Index(fields=['event', 'status'], name='events_enroll_event_status_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='enrollment',
+            index=models.Index(fields=['created_by', 'event'], name='events_enroll_user_event_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='event',
+            index=models.Index(fields=['created_by', 'starts_at'], name='events_event_host_starts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='event',
+            index=models.Index(fields=['category', 'starts_at'], name='events_event_cat_starts_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='profile',
+            index=models.Index(fields=['token'], name='events_profile_token_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rating',
+            index=models.Index(fields=['reviewed', 'on'], name='events_rating_reviewed_on_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rating',
+            index=models.Index(fields=['created_by', 'event', 'reviewed'], name='events_rating_user_event_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='transaction',
+            index=models.Index(fields=['created_by', 'event'], name='events_trans_user_event_idx'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:14
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+SEARCH_VECTOR_FUNCTION = """
+CREATE OR REPLACE FUNCTION events_event_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('spanish', f_unaccent(coalesce(NEW.title, ''))), 'A') ||
+        setweight(to_tsvector('spanish', f_unaccent(coalesce(
+            (SELECT name FROM events_category WHERE id = NEW.category_id), ''))), 'B') ||
+        setweight(to_tsvector('spanish', f_unaccent(coalesce(NEW.description, ''))), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+
+CATEGORY_RENAME_FUNCTION = """
+CREATE OR REPLACE FUNCTION events_category_search_vector() RETURNS trigger AS $$
+BEGIN
+    -- touching the title recomputes the vector of every event in the category
+    UPDATE events_event SET title = title WHERE category_id = NEW.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('events', '0011_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(SEARCH_VECTOR_FUNCTION,
+                          'DROP FUNCTION IF EXISTS events_event_search_vector()'),
+        migrations.RunSQL(
+            'CREATE TRIGGER events_event_search_vector_update '
+            'BEFORE INSERT OR UPDATE OF title, description, category_id ON events_event '
+            'FOR EACH ROW EXECUTE PROCEDURE events_event_search_vector()',
+            'DROP TRIGGER IF EXISTS events_event_search_vector_update ON events_event'),
+        migrations.RunSQL(CATEGORY_RENAME_FUNCTION,
+                          'DROP FUNCTION IF EXISTS events_category_search_vector()'),
+        migrations.RunSQL(
+            'CREATE TRIGGER events_category_search_vector_update '
+            'AFTER UPDATE OF name ON events_category '
+            'FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name) '
+            'EXECUTE PROCEDURE events_category_search_vector()',
+            'DROP TRIGGER IF EXISTS events_category_search_vector_update ON events_category'),
+        migrations.RunSQL('UPDATE events_event SET title = title',
+                          migrations.RunSQL.noop),
+        AddIndexConcurrently(
+            model_name='event',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='events_event_search_idx'),
+        ),
+    ]
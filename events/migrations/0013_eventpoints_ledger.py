@@ -0,0 +1,42 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('events', '0012_event_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventpointsEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.IntegerField(verbose_name='Points')),
+                ('reason', models.CharField(choices=[('OPENING', 'Opening balance'), ('SIGNUP', 'Signup'), ('REFERRAL', 'Referral'), ('BONUS', 'Bonus'), ('DISCOUNT', 'Discount'), ('REFUND', 'Refund')], max_length=8, verbose_name='Reason')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Created at')),
+                ('transaction', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='eventpoints_entries', to='events.Transaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='eventpoints_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Eventpoints entry',
+                'verbose_name_plural': 'Eventpoints entries',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='eventpointsentry',
+            index=models.Index(fields=['user', 'created_at'], name='events_points_user_created_idx'),
+        ),
+        # the balances so far become the first entry of every ledger
+        migrations.RunSQL(
+            "INSERT INTO events_eventpointsentry (user_id, points, reason, created_at) "
+            "SELECT user_id, eventpoints, 'OPENING', now() FROM events_profile WHERE eventpoints <> 0",
+            migrations.RunSQL.noop),
+    ]
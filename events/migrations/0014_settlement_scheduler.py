@@ -0,0 +1,31 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:31
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0013_eventpoints_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SettlementCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ends_at', models.DateTimeField(blank=True, null=True, verbose_name='Ends at')),
+                ('event_id', models.IntegerField(blank=True, null=True, verbose_name='Event')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Updated at')),
+            ],
+            options={
+                'verbose_name': 'Settlement checkpoint',
+                'verbose_name_plural': 'Settlement checkpoints',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(is_paid_for=False), fields=['ends_at', 'id'], name='events_event_unpaid_ends_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:33
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0014_settlement_scheduler'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False, verbose_name='Stripe event id')),
+                ('type', models.CharField(max_length=100, verbose_name='Type')),
+                ('payload', django.contrib.postgres.fields.jsonb.JSONField(verbose_name='Payload')),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Received at')),
+                ('processed_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Processed at')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Attempts')),
+                ('next_attempt_at', models.DateTimeField(blank=True, default=django.utils.timezone.now, editable=False, null=True, verbose_name='Next attempt at')),
+                ('last_error', models.TextField(blank=True, editable=False, null=True, verbose_name='Last error')),
+            ],
+            options={
+                'verbose_name': 'Stripe event',
+                'verbose_name_plural': 'Stripe events',
+                'ordering': ['received_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(condition=models.Q(processed_at__isnull=True), fields=['next_attempt_at'], name='events_stripe_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0015_stripe_event'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='dataexport',
+            name='events_export_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='dataexport',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Attempts'),
+        ),
+        migrations.AddField(
+            model_name='dataexport',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, editable=False, null=True, verbose_name='Next attempt at'),
+        ),
+        migrations.AddIndex(
+            model_name='dataexport',
+            index=models.Index(condition=models.Q(status='PENDING'), fields=['next_attempt_at'], name='events_export_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0016_data_export_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='payout_claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Payout claimed at'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0017_transaction_payout_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='payout_attempts',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Payout attempts'),
+        ),
+    ]
@@ -1,35 +1,49 @@
 import pytz
 import random
+import time
 import uuid
 
 from datetime import datetime, date, timedelta
 
 from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.db.models import Avg, Q
-from django.db.models.signals import pre_delete
+from django.db import transaction as db_transaction
+from django.db.models import Avg, F, Q
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils.crypto import get_random_string
+from django.utils.timezone import make_aware, now
 
 from core.models import Common
+from events import lookups  # registers the immutable_unaccent lookup
+from events import caches
+from events.backends import get_export_storage, get_geocoder
 
 # Create your models here.
 
 
 User = get_user_model()
 
+SEARCH_VERSION_KEY = 'events:search:version'
+
 
 @receiver(pre_delete, sender=User, dispatch_uid='user_delete_signal')
 def change_events_location_on_user_deletion(sender, instance, using, **kwargs):
     Event.objects.filter(created_by=instance).update(
         location_city='No disponible',
         location_street='No disponible',
-        location_number=0
+        location_number=0,
+        latitude=None,
+        longitude=None
     )
     today = datetime.now().date()
     Event.objects.filter(
@@ -79,6 +93,16 @@ class Profile(models.Model):
         'stripe_access_token', max_length=250, blank=True, null=True, editable=False)
     stripe_user_id = models.CharField(
         'stripe_user_id', max_length=250, blank=True, null=True, editable=False)
+    stripe_customer_id = models.CharField(
+        'stripe_customer_id', max_length=250, blank=True, null=True, editable=False, db_index=True)
+    attendee_rating_count = models.PositiveIntegerField(
+        'Attendee ratings', default=0, editable=False)
+    attendee_rating_sum = models.PositiveIntegerField(
+        'Attendee ratings score', default=0, editable=False)
+    host_rating_count = models.PositiveIntegerField(
+        'Host ratings', default=0, editable=False)
+    host_rating_sum = models.PositiveIntegerField(
+        'Host ratings score', default=0, editable=False)
 
     @property
     def age(self):
@@ -88,13 +112,15 @@ class Profile(models.Model):
 
     @property
     def avg_attendee_score(self):
-        return self.user.reviewed_ratings.filter(on='ATTENDEE').aggregate(
-            models.Avg('score'))['score__avg']
+        if self.attendee_rating_count:
+            return self.attendee_rating_sum / self.attendee_rating_count
+        return None
 
     @property
     def avg_host_score(self):
-        return self.user.reviewed_ratings.filter(on='HOST').aggregate(
-            models.Avg('score'))['score__avg']
+        if self.host_rating_count:
+            return self.host_rating_sum / self.host_rating_count
+        return None
 
     @property
     def discount(self):
@@ -106,6 +132,7 @@ class Profile(models.Model):
         super(Profile, self).save(*args, **kwargs)
 
     class Meta:
+        indexes = [models.Index(fields=['token'], name='events_profile_token_idx')]
         verbose_name = 'Profile'
         verbose_name_plural = 'Profiles'
 
@@ -127,6 +154,10 @@ class Category(models.Model):
 
 
 class Event(Common):
+    LOCATION_FIELDS = {'location_city', 'location_street', 'location_number'}
+    # written with relative updates by the enrollments, the payouts and the search trigger
+    MAINTAINED_FIELDS = {'accepted_count', 'is_paid_for', 'search_vector'}
+
     title = models.CharField('Title', max_length=250)
     description = models.TextField('Description')
     picture = models.ImageField('Picture url', upload_to='event')
@@ -134,10 +165,19 @@ class Event(Common):
     location_city = models.CharField('City', max_length=250)
     location_street = models.CharField('Street', max_length=250)
     location_number = models.PositiveIntegerField('Street number')
+    latitude = models.FloatField(
+        'Latitude', blank=True, null=True, editable=False)
+    longitude = models.FloatField(
+        'Longitude', blank=True, null=True, editable=False)
 
     start_day = models.DateField('Starting day')
     start_time = models.TimeField('Starting time')
     end_time = models.TimeField('Ending time')
+    # start_day with start_time and end_time in the local timezone, kept by the pre_save signal
+    starts_at = models.DateTimeField(
+        'Starts at', blank=True, editable=False, db_index=True)
+    ends_at = models.DateTimeField(
+        'Ends at', blank=True, editable=False, db_index=True)
     price = models.DecimalField(
         'Price', max_digits=6, decimal_places=2)
     capacity = models.PositiveSmallIntegerField('Capacity')
@@ -148,16 +188,23 @@ class Event(Common):
     extra_info = models.TextField(
         'Extra info for the attendee', blank=True, null=True)
     is_paid_for = models.BooleanField('Is paid for?')
+    accepted_count = models.PositiveSmallIntegerField(
+        'Accepted attendees', default=0, editable=False)
+    # weighted title, category name and description, kept by a trigger (migration 0012)
+    search_vector = SearchVectorField(null=True, editable=False)
     created_by = models.ForeignKey(User, on_delete=models.SET(
         get_sentinel_user), related_name='host_events', default='')
     category = models.ForeignKey(
         Category, on_delete=models.SET(get_default_category), related_name='category_events')
 
     class Meta:
-        indexes = [models.Index(
-            fields=['-location_city', '-location_street', '-location_number', 'start_day', 'end_time', 'start_time',
-                    'price',
-                    'category'])]
+        # the trigram index on f_unaccent(location_city) is created in SQL by migration 0011
+        indexes = [models.Index(fields=['latitude', 'longitude']),
+                   models.Index(fields=['created_by', 'starts_at'], name='events_event_host_starts_idx'),
+                   models.Index(fields=['category', 'starts_at'], name='events_event_cat_starts_idx'),
+                   GinIndex(fields=['search_vector'], name='events_event_search_idx'),
+                   models.Index(fields=['ends_at', 'id'], name='events_event_unpaid_ends_idx',
+                                condition=Q(is_paid_for=False))]
         ordering = ['price', '-start_day', '-title']
         verbose_name = 'Event'
         verbose_name_plural = 'Events'
@@ -172,15 +219,17 @@ class Event(Common):
 
         return int(duration)
 
+    @property
+    def is_full(self):
+        return self.accepted_count >= self.capacity
+
     @property
     def has_finished(self):
-        end_datetime = datetime.combine(self.start_day, self.end_time)
-        return end_datetime <= datetime.now()
+        return self.ends_at <= now()
 
     @property
     def has_started(self):
-        start_datetime = datetime.combine(self.start_day, self.start_time)
-        return start_datetime <= datetime.now()
+        return self.starts_at <= now()
 
     @property
     def location(self):
@@ -191,6 +240,10 @@ class Event(Common):
         aux = ','.join([self.location_street, self.location_city])
         return '+'.join([str(self.location_number), aux])
 
+    @property
+    def geocoding_address(self):
+        return '{0} {1}, {2}'.format(self.location_number, self.location_street, self.location_city)
+
     @property
     def can_update(self):
         return datetime.now().date() < (self.start_day - timedelta(days=4))
@@ -200,14 +253,77 @@ class Event(Common):
 
         return datetime.now().date() < (self.start_day - timedelta(days=4))
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Event, cls).from_db(db, field_names, values)
+        if cls.LOCATION_FIELDS.issubset(field_names):
+            if 'latitude' in field_names and instance.latitude is not None:
+                # the events stored without coordinates try the geocoder again on their next save
+                instance._geocoded_address = instance.geocoding_address
+            instance._indexed_city = instance.location_city
+        return instance
+
+    def timestamps(self):
+        return (make_aware(datetime.combine(self.start_day, self.start_time), is_dst=False),
+                make_aware(datetime.combine(self.start_day, self.end_time), is_dst=False))
+
+    def geocode(self):
+        coordinates = get_geocoder().geocode(self.geocoding_address)
+        self.latitude, self.longitude = coordinates or (None, None)
+        self._geocoded_address = self.geocoding_address
+
     def save(self, *args, **kwargs):
         self.full_clean()
+        # only hit the geocoder when the address is new or has changed, an address it could not
+        # place is not looked up again
+        if self.geocoding_address != getattr(self, '_geocoded_address', None):
+            self.geocode()
         super(Event, self).save(*args, **kwargs)
 
     def __str__(self):
         return self.title
 
 
+@receiver(pre_save, sender=Event, dispatch_uid='event_timestamps_signal')
+def set_event_timestamps(sender, instance, raw, **kwargs):
+    # also runs for loaddata, which bypasses Event.save
+    instance.starts_at, instance.ends_at = instance.timestamps()
+
+
+def search_version() -> int:
+    # part of every cached search key, a fresh value orphans the cached results
+    return cache.get_or_set(SEARCH_VERSION_KEY, time.time_ns, None)
+
+
+@receiver(post_save, sender=Event, dispatch_uid='event_save_search_signal')
+@receiver(post_delete, sender=Event, dispatch_uid='event_delete_search_signal')
+@receiver(post_save, sender=Category, dispatch_uid='category_save_search_signal')
+@receiver(post_delete, sender=Category, dispatch_uid='category_delete_search_signal')
+def expire_search_results(sender, using, **kwargs):
+    # a search cached between the bump and the commit would keep the old results
+    db_transaction.on_commit(bump_search_version, using)
+
+
+def bump_search_version():
+    try:
+        cache.incr(SEARCH_VERSION_KEY)
+    except ValueError:
+        search_version()
+
+
+@receiver(post_save, sender=Event, dispatch_uid='event_save_city_signal')
+def expire_city_index(sender, instance, created, using, **kwargs):
+    # every process rebuilds its index when the cities change, once they are committed
+    if created or getattr(instance, '_indexed_city', None) != instance.location_city:
+        caches.city_index.expire(using)
+    instance._indexed_city = instance.location_city
+
+
+@receiver(post_delete, sender=Event, dispatch_uid='event_delete_city_signal')
+def expire_deleted_city(sender, instance, using, **kwargs):
+    caches.city_index.expire(using)
+
+
 class Enrollment(Common):
     STATUS_CHOICES = (
         ('ACCEPTED', 'Accepted'),
@@ -224,6 +340,10 @@ class Enrollment(Common):
         Event, on_delete=models.CASCADE, related_name='event_enrollments')
 
     class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=['event', 'created_by'], name='unique_enrollment_per_attendee')]
+        indexes = [models.Index(fields=['event', 'status'], name='events_enroll_event_status_idx'),
+                   models.Index(fields=['created_by', 'event'], name='events_enroll_user_event_idx')]
         ordering = ['-created_at']
         verbose_name = 'Enrollment'
         verbose_name_plural = 'Enrollments'
@@ -244,6 +364,13 @@ class Enrollment(Common):
         return self.status == 'REJECTED'
 
 
+@receiver(post_delete, sender=Enrollment, dispatch_uid='enrollment_delete_signal')
+def update_accepted_count_on_enrollment_deletion(sender, instance, using, **kwargs):
+    if instance.is_accepted:
+        Event.objects.filter(pk=instance.event_id).update(
+            accepted_count=F('accepted_count') - 1)
+
+
 class Rating(Common):
     ON_CHOICES = (
         ('ATTENDEE', 'attendee'),
@@ -263,6 +390,8 @@ class Rating(Common):
         User, on_delete=models.CASCADE, related_name='reviewed_ratings')
 
     class Meta:
+        indexes = [models.Index(fields=['reviewed', 'on'], name='events_rating_reviewed_on_idx'),
+                   models.Index(fields=['created_by', 'event', 'reviewed'], name='events_rating_user_event_idx')]
         ordering = ['-score']
         verbose_name = 'Rating'
         verbose_name_plural = 'Ratings'
@@ -273,6 +402,20 @@ class Rating(Common):
     def get_absolute_url(self):
         return reverse('rating-detail', kwargs={'pk': self.pk})
 
+    @staticmethod
+    def score_fields(on: str):
+        prefix = on.lower()
+        return prefix + '_rating_count', prefix + '_rating_sum'
+
+
+@receiver(post_delete, sender=Rating, dispatch_uid='rating_delete_signal')
+def update_profile_scores_on_rating_deletion(sender, instance, using, **kwargs):
+    count_field, sum_field = Rating.score_fields(instance.on)
+    Profile.objects.filter(user_id=instance.reviewed_id).update(**{
+        count_field: F(count_field) - 1,
+        sum_field: F(sum_field) - instance.score
+    })
+
 
 class Transaction(Common):
     id = models.UUIDField('Id', primary_key=True,
@@ -285,9 +428,17 @@ class Transaction(Common):
     discount = models.PositiveIntegerField('Discount')
     fee = models.PositiveIntegerField('Fee')
     customer_id = models.CharField('Customer_id', max_length=250)
+    charge_id = models.CharField(
+        'Charge_id', max_length=250, blank=True, null=True, editable=False)
     event = models.ForeignKey(
         Event, on_delete=models.CASCADE, related_name='event_transaction')
     is_paid_for = models.BooleanField('Is paid for?')
+    # set while a payout charges it, a payout interrupted for longer than PAYOUT_CLAIM_TIMEOUT is charged again
+    payout_claimed_at = models.DateTimeField(
+        'Payout claimed at', blank=True, null=True, editable=False)
+    # every failed charge is retried with a new idempotency key, Stripe would replay the failure otherwise
+    payout_attempts = models.PositiveIntegerField(
+        'Payout attempts', default=0, editable=False)
 
     @property
     def actual_amount(self):
@@ -298,6 +449,7 @@ class Transaction(Common):
         return self.fee - self.discount
 
     class Meta:
+        indexes = [models.Index(fields=['created_by', 'event'], name='events_trans_user_event_idx')]
         ordering = ['-created_at']
         verbose_name = 'Transaction'
         verbose_name_plural = 'Transactions'
@@ -306,6 +458,37 @@ class Transaction(Common):
         return str(self.id)
 
 
+class EventpointsEntry(models.Model):
+    REASON_CHOICES = (
+        ('OPENING', 'Opening balance'),
+        ('SIGNUP', 'Signup'),
+        ('REFERRAL', 'Referral'),
+        ('BONUS', 'Bonus'),
+        ('DISCOUNT', 'Discount'),
+        ('REFUND', 'Refund'),
+    )
+
+    # credits are positive and debits negative, the profile balance is their sum
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='eventpoints_entries')
+    points = models.IntegerField('Points')
+    reason = models.CharField('Reason', max_length=8, choices=REASON_CHOICES)
+    # entries are never rewritten, they keep pointing to the transactions deleted by refunds
+    transaction = models.ForeignKey(
+        Transaction, on_delete=models.DO_NOTHING, db_constraint=False, related_name='eventpoints_entries',
+        blank=True, null=True)
+    created_at = models.DateTimeField('Created at', default=now, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'created_at'], name='events_points_user_created_idx')]
+        ordering = ['-created_at']
+        verbose_name = 'Eventpoints entry'
+        verbose_name_plural = 'Eventpoints entries'
+
+    def __str__(self):
+        return '{0} {1:+d}'.format(self.user, self.points)
+
+
 class Message(Common):
     title = models.CharField('Title', max_length=250)
     description = models.TextField('Description')
@@ -318,3 +501,127 @@ class Message(Common):
 
     def __str__(self):
         return str(self.title)
+
+
+@receiver(post_save, sender=Message, dispatch_uid='message_save_signal')
+@receiver(post_delete, sender=Message, dispatch_uid='message_delete_signal')
+def expire_last_message(sender, using, **kwargs):
+    caches.last_message.expire(using)
+
+
+class OutboxEmail(models.Model):
+    subject = models.CharField('Subject', max_length=250)
+    body = models.TextField('Body')
+    recipient = models.EmailField('Recipient')
+    created_at = models.DateTimeField('Created at', default=now, editable=False)
+    sent_at = models.DateTimeField(
+        'Sent at', blank=True, null=True, editable=False)
+    attempts = models.PositiveSmallIntegerField(
+        'Attempts', default=0, editable=False)
+    next_attempt_at = models.DateTimeField(
+        'Next attempt at', default=now, blank=True, null=True, editable=False)
+    last_error = models.TextField(
+        'Last error', blank=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['next_attempt_at'], name='events_outbox_pending_idx',
+                                condition=Q(sent_at__isnull=True))]
+        ordering = ['created_at']
+        verbose_name = 'Outbox email'
+        verbose_name_plural = 'Outbox emails'
+
+    def __str__(self):
+        return '{0} to {1}'.format(self.subject, self.recipient)
+
+
+class StripeEvent(models.Model):
+    # inbox of the webhook events, stored once per Stripe event id and processed apart from the request
+    id = models.CharField('Stripe event id', max_length=255, primary_key=True)
+    type = models.CharField('Type', max_length=100)
+    payload = JSONField('Payload')
+    received_at = models.DateTimeField('Received at', default=now, editable=False)
+    processed_at = models.DateTimeField(
+        'Processed at', blank=True, null=True, editable=False)
+    attempts = models.PositiveSmallIntegerField(
+        'Attempts', default=0, editable=False)
+    next_attempt_at = models.DateTimeField(
+        'Next attempt at', default=now, blank=True, null=True, editable=False)
+    last_error = models.TextField(
+        'Last error', blank=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['next_attempt_at'], name='events_stripe_pending_idx',
+                                condition=Q(processed_at__isnull=True))]
+        ordering = ['received_at']
+        verbose_name = 'Stripe event'
+        verbose_name_plural = 'Stripe events'
+
+    def __str__(self):
+        return '{0} {1}'.format(self.type, self.id)
+
+    @property
+    def data(self):
+        return self.payload['data']['object']
+
+
+class SettlementCheckpoint(models.Model):
+    # the last event handed out by the settlement scheduler, the next batch starts after it
+    ends_at = models.DateTimeField('Ends at', blank=True, null=True)
+    event_id = models.IntegerField('Event', blank=True, null=True)
+    updated_at = models.DateTimeField('Updated at', default=now)
+
+    class Meta:
+        verbose_name = 'Settlement checkpoint'
+        verbose_name_plural = 'Settlement checkpoints'
+
+    def __str__(self):
+        return 'Settled up to event {0}'.format(self.event_id)
+
+
+class DataExport(models.Model):
+    STATUS_CHOICES = (
+        ('PENDING', 'Pending'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed')
+    )
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='data_exports')
+    version = models.CharField('Data version', max_length=40)
+    status = models.CharField('Status', max_length=8,
+                              choices=STATUS_CHOICES, default='PENDING')
+    file_name = models.CharField(
+        'File name', max_length=250, blank=True, null=True, editable=False)
+    created_at = models.DateTimeField('Created at', default=now, editable=False)
+    finished_at = models.DateTimeField(
+        'Finished at', blank=True, null=True, editable=False)
+    attempts = models.PositiveSmallIntegerField(
+        'Attempts', default=0, editable=False)
+    next_attempt_at = models.DateTimeField(
+        'Next attempt at', default=now, blank=True, null=True, editable=False)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=['user', 'version'], name='unique_data_export_version')]
+        indexes = [models.Index(fields=['next_attempt_at'], name='events_export_pending_idx',
+                                condition=Q(status='PENDING'))]
+        ordering = ['-created_at']
+        verbose_name = 'Data export'
+        verbose_name_plural = 'Data exports'
+
+    def __str__(self):
+        return '{0} export {1}'.format(self.user, self.version)
+
+    @property
+    def is_done(self):
+        return self.status == 'DONE'
+
+    @property
+    def is_failed(self):
+        return self.status == 'FAILED'
+
+
+@receiver(post_delete, sender=DataExport, dispatch_uid='data_export_delete_signal')
+def delete_export_file(sender, instance, using, **kwargs):
+    if instance.file_name:
+        get_export_storage().delete(instance.file_name)
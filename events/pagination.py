@@ -0,0 +1,152 @@
+from django.core import signing
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+
+CURSOR_SALT = 'events.pagination'
+COUNT_CAP = 1000
+
+
+class KeysetPaginator:
+    def __init__(self, queryset: QuerySet, per_page: int, ordering, count_cap: int = COUNT_CAP):
+        # the ordering must end with a unique field, usually pk, for the cursors to be exact
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.count_cap = count_cap
+
+    @cached_property
+    def capped_count(self) -> int:
+        # never counts past the cap, deep result sets are shown as "N+"
+        return self.queryset.order_by()[:self.count_cap + 1].count()
+
+    @property
+    def count(self) -> int:
+        return min(self.capped_count, self.count_cap)
+
+    @property
+    def count_is_capped(self) -> bool:
+        return self.capped_count > self.count_cap
+
+    def page(self, after: str = None, before: str = None) -> 'KeysetPage':
+        after, before = self.decode(after), self.decode(before)
+        if before is not None:
+            rows = self.fetch(self.keyset_filter(before, reverse=True), self.reversed_ordering(),
+                              self.per_page + 1)
+            return KeysetPage(self, rows[:self.per_page][::-1],
+                              has_previous=len(rows) > self.per_page, has_next=True)
+
+        condition = self.keyset_filter(after) if after is not None else Q()
+        rows = self.fetch(condition, self.ordering, self.per_page + 1)
+        if after is None and len(rows) <= self.per_page:
+            # a single page already holds every result
+            self.capped_count = len(rows)
+        return KeysetPage(self, rows[:self.per_page],
+                          has_previous=after is not None, has_next=len(rows) > self.per_page)
+
+    def fetch(self, condition: Q, ordering, limit: int) -> list:
+        return list(self.queryset.filter(condition).order_by(*ordering)[:limit])
+
+    def reversed_ordering(self) -> list:
+        return [field[1:] if field.startswith('-') else '-' + field for field in self.ordering]
+
+    def keyset_filter(self, values: list, reverse: bool = False) -> Q:
+        # (a, b) > (x, y) spelled out as a > x OR (a = x AND b > y), per field direction
+        condition = Q()
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            descending = field.startswith('-') != reverse
+            clause = Q(**{'{0}__{1}'.format(name, 'lt' if descending else 'gt'): values[index]})
+            for previous, value in zip(self.ordering[:index], values[:index]):
+                clause &= Q(**{previous.lstrip('-'): value})
+            condition |= clause
+        return condition
+
+    def encode(self, row) -> str:
+        values = []
+        for field in self.ordering:
+            value = row
+            for attribute in field.lstrip('-').split('__'):
+                value = getattr(value, attribute)
+            # the fields parse their own string form back when filtering
+            values.append(str(value))
+        # the values only fit the fields of this ordering, a cursor kept across a change of sort is dropped
+        return signing.dumps({'ordering': self.ordering, 'values': values}, salt=CURSOR_SALT)
+
+    def decode(self, cursor: str):
+        if not cursor:
+            return None
+        try:
+            payload = signing.loads(cursor, salt=CURSOR_SALT)
+        except signing.BadSignature:
+            return None
+        if not isinstance(payload, dict) or tuple(payload.get('ordering', ())) != self.ordering:
+            return None
+        return payload.get('values')
+
+
+class CachedKeysetPaginator(KeysetPaginator):
+    # loads the pages with the pks that results caches for the shared, user independent, queryset
+    def __init__(self, queryset: QuerySet, per_page: int, ordering, results, shared: QuerySet,
+                 count_cap: int = COUNT_CAP):
+        super().__init__(queryset, per_page, ordering, count_cap)
+        self.results = results
+        self.shared = shared
+
+    @cached_property
+    def capped_count(self) -> int:
+        return self.results.count(self.queryset, self.shared, self.count_cap)
+
+    def fetch(self, condition: Q, ordering, limit: int) -> list:
+        return self.results.rows(self.queryset.filter(condition).order_by(*ordering),
+                                 self.shared.filter(condition).order_by(*ordering), limit, ordering, str(condition))
+
+
+class KeysetPage:
+    def __init__(self, paginator: KeysetPaginator, object_list: list, has_previous: bool, has_next: bool):
+        self.paginator = paginator
+        self.object_list = object_list
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self) -> bool:
+        return self._has_next
+
+    def has_previous(self) -> bool:
+        return self._has_previous
+
+    def has_other_pages(self) -> bool:
+        return self._has_next or self._has_previous
+
+    @cached_property
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return self.paginator.encode(self.object_list[-1])
+        return None
+
+    @cached_property
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return self.paginator.encode(self.object_list[0])
+        return None
+
+
+class KeysetPaginationMixin:
+    # for ListView, replaces the OFFSET paginator with ?after= and ?before= cursors
+    keyset = ('pk',)
+
+    def get_keyset(self):
+        return self.keyset
+
+    def get_keyset_paginator(self, queryset, page_size) -> KeysetPaginator:
+        return KeysetPaginator(queryset, page_size, self.get_keyset())
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_keyset_paginator(queryset, page_size)
+        page = paginator.page(self.request.GET.get('after'), self.request.GET.get('before'))
+        return (paginator, page, page.object_list, page.has_other_pages())
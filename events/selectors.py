@@ -1,18 +1,38 @@
-import googlemaps
+import hashlib
+import json
 
-from collections import OrderedDict
 from datetime import datetime, time, timedelta
-from operator import itemgetter
+from math import cos, radians
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Count, F, FloatField, Sum, Q, QuerySet
-from django.db.models.functions import Cast
+from django.contrib.postgres.search import SearchRank
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import (Case, Count, ExpressionWrapper, F, FloatField, IntegerField, OuterRef, Sum, Q,
+                              QuerySet, Subquery, Value, When)
+from django.db.models.functions import ASin, Cast, Cos, Power, Radians, Sin, Sqrt
+from django.utils.timezone import localdate, make_aware, now
 
 from . import models
+from .lookups import UnaccentSearchQuery
 
 User = get_user_model()
 
+EARTH_RADIUS = 6371000
+SEARCH_CONFIG = 'spanish'
+METERS_PER_DEGREE = 111320
+
+# upper bound of every price facet, the events above the last one fall in a None bucket
+PRICE_FACETS = (0, 10, 25)
+FACETS_SQL = '''
+    WITH results AS ({0})
+    SELECT GROUPING(facet_category, facet_price, facet_day, facet_city),
+           facet_category, facet_category_name, facet_price, facet_day, facet_city, COUNT(*)
+    FROM results
+    GROUP BY GROUPING SETS ((facet_category, facet_category_name), (facet_price), (facet_day), (facet_city), ())
+'''
+
 
 class EnrollmentSelector:
     def created_by(self, user: User) -> QuerySet:
@@ -26,6 +46,14 @@ class EnrollmentSelector:
 
 
 class EventSelector:
+    def detail(self, user: User) -> QuerySet:
+        # everything the detail page shows, with the status of the user's enrollment if there is one
+        events = models.Event.objects.select_related('created_by__profile', 'category')
+        if user.is_authenticated:
+            events = events.annotate(user_enrollment_status=Subquery(models.Enrollment.objects.filter(
+                event=OuterRef('pk'), created_by=user).values('status')[:1]))
+        return events
+
     def hosted(self, host: User) -> QuerySet:
         hosted_events = models.Event.objects.filter(
             created_by=host)
@@ -41,16 +69,21 @@ class EventSelector:
             event_enrollments__created_by=attendee)
         return not_enrolled_events
 
+    def unsettled(self) -> QuerySet:
+        # finished and not paid out yet, for hosts that can receive payouts
+        return models.Event.objects.filter(
+            is_paid_for=False, ends_at__lte=now(), created_by__profile__stripe_user_id__isnull=False)
+
     def not_started(self, events):
-        now = datetime.now()
-        return events.filter(Q(start_day__gte=now.date(), start_time__gte=now.time()) | Q(start_day__gte=now.date()))
+        return events.filter(starts_at__gt=now())
 
     def penalized(self, user: User) -> int:
-        today = datetime.now().date()
+        # events starting from now until the end of the fourth day from today
+        until = make_aware(datetime.combine(
+            localdate() + timedelta(days=5), time.min))
         return models.Enrollment.objects.filter(
             event__created_by=user,
-            event__start_day__gte=today,
-            event__start_day__lte=today + timedelta(days=4),
+            event__starts_at__range=(now(), until),
             status='ACCEPTED'
         ).values('event__price').annotate(
             count=Count('event'),
@@ -59,71 +92,153 @@ class EventSelector:
     def rated_by_user(self, user: User, on='HOST') -> QuerySet:
         return models.Event.objects.filter(ratings__created_by=user, ratings__on=on)
 
-    def nearby_events_distance(self, user, distance, latitude, longitude, **kwargs):
+    def nearby_events_distance(self, user, distance, latitude, longitude, search=None, **kwargs):
         filters = {key: val for key, val in kwargs.items() if val}
         events = self.base_search_events(user).filter(**filters)
-        result = []
-
-        if events:
-            events_distances_oredered = self.common_method_distance_order(
-                events, latitude, longitude)
-
-            for event, eventdistance in events_distances_oredered.items():
-                if eventdistance <= int(distance):
-                    result.append(event.id)
-                else:
-                    break
-        return models.Event.objects.filter(pk__in=result)
-
-    def events_filter_search(self, user: User, **kwargs) -> QuerySet:
+        if search:
+            events = events.filter(search_vector=UnaccentSearchQuery(search, config=SEARCH_CONFIG))
+        return self.within_distance(events, distance, latitude, longitude)
+
+    def within_distance(self, events, distance, latitude, longitude) -> QuerySet:
+        distance = int(distance)
+        latitude = float(latitude)
+        longitude = float(longitude)
+
+        # cheap bounding box on the indexed coordinates before the haversine ranking
+        lat_delta = distance / METERS_PER_DEGREE
+        lng_delta = distance / \
+            (METERS_PER_DEGREE * max(cos(radians(latitude)), 0.01))
+        events = events.filter(
+            latitude__range=(latitude - lat_delta, latitude + lat_delta),
+            longitude__range=(longitude - lng_delta, longitude + lng_delta))
+
+        origin_latitude = Value(latitude, output_field=FloatField())
+        origin_longitude = Value(longitude, output_field=FloatField())
+        half_dlat = Radians(F('latitude') - origin_latitude) / 2
+        half_dlng = Radians(F('longitude') - origin_longitude) / 2
+        haversine = Power(Sin(half_dlat), 2) + Cos(Radians(origin_latitude)) * \
+            Cos(Radians(F('latitude'))) * Power(Sin(half_dlng), 2)
+
+        return events.annotate(
+            distance=ExpressionWrapper(
+                2 * EARTH_RADIUS * ASin(Sqrt(haversine)), output_field=FloatField())
+        ).filter(distance__lte=distance).order_by('distance')
+
+    def events_filter_search(self, user: User, search=None, **kwargs) -> QuerySet:
         events = self.base_search_events(user)
         filters = {key: val for key, val in kwargs.items() if val}
-        return events.filter(**filters)
+        events = events.filter(**filters)
+        if search:
+            events = self.text_search(events, search)
+        return events
+
+    def text_search(self, events, text: str) -> QuerySet:
+        query = UnaccentSearchQuery(text, config=SEARCH_CONFIG)
+        # double precision, so that the rank round-trips exactly through a pagination cursor
+        return events.filter(search_vector=query).annotate(
+            rank=Cast(SearchRank(F('search_vector'), query), FloatField())).order_by('-rank', 'starts_at')
+
+    def facets(self, events: QuerySet) -> dict:
+        # the total and the category, price, day and city counts of every result in one grouped pass
+        prices = [When(price__lte=bound, then=Value(bound)) for bound in PRICE_FACETS]
+        events = events.order_by().annotate(
+            facet_category=F('category_id'), facet_category_name=F('category__name'),
+            facet_price=Case(*prices, default=Value(None), output_field=IntegerField()),
+            facet_day=F('start_day'), facet_city=F('location_city'),
+        ).values('facet_category', 'facet_category_name', 'facet_price', 'facet_day', 'facet_city')
+        sql, params = events.query.sql_with_params()
+        with connections[events.db].cursor() as cursor:
+            cursor.execute(FACETS_SQL.format(sql), params)
+            rows = cursor.fetchall()
+
+        # GROUPING() sets a bit for every column left out of the row's grouping set
+        facets = {'total': 0, 'categories': [], 'prices': [], 'days': [], 'cities': []}
+        for grouping, category, name, price, day, city, total in rows:
+            if grouping == 0b0111:
+                facets['categories'].append((category, name, total))
+            elif grouping == 0b1011:
+                facets['prices'].append((price, total))
+            elif grouping == 0b1101:
+                facets['days'].append((day, total))
+            elif grouping == 0b1110:
+                facets['cities'].append((city, total))
+            else:
+                facets['total'] = total
+        facets['categories'].sort(key=lambda facet: -facet[2])
+        facets['prices'].sort(key=lambda facet: (facet[0] is None, facet[0]))
+        facets['days'].sort()
+        facets['cities'].sort(key=lambda facet: -facet[1])
+        return facets
 
     def base_search_events(self, user: User) -> QuerySet:
-        now = datetime.now()
+        events = self.not_started(models.Event.objects.all())
         if user.is_authenticated:
-            events = models.Event.objects.filter(
-                ~Q(event_enrollments__created_by=user) & (Q(start_day__gte=now.date(), start_time__gte=now.time()) | Q(start_day__gte=now.date())))
-        else:
-            events = models.Event.objects.filter(Q(start_day__gte=now.date(
-            ), start_time__gte=now.time()) | Q(start_day__gte=now.date()))
+            events = events.filter(~Q(event_enrollments__created_by=user))
         return events
 
-    def common_method_distance_order(self, events, latitude, longitude):
-        gmaps = googlemaps.Client(key=settings.GOOGLE_API_KEY)
-        events_distances = {}
 
-        latitude_user = latitude
-        longitude_user = longitude
+class SearchResultCache:
+    # pks of the search pages as anonymous visitors see them, logged-in users load the
+    # same pks through their own queryset, which leaves out the events they enrolled in
+    slack = 12
 
-        origins = [{"lat": latitude_user, "lng": longitude_user}]
+    def __init__(self, user: User, search=None, **filters):
+        self.user = user
+        self.parts = [normalize(search), sorted((key, normalize(val)) for key, val in filters.items() if val)]
 
-        new_event_list = [events[i:i+20] for i in range(0, len(events), 20)]
+    def key(self, *parts) -> str:
+        key = json.dumps([models.search_version()] + self.parts + list(parts), default=str)
+        return 'events:search:' + hashlib.sha1(key.encode()).hexdigest()
 
-        for event_list in new_event_list:
-            destinations = ""
+    def count(self, queryset: QuerySet, shared: QuerySet, cap: int) -> int:
+        if self.user.is_authenticated:
+            return queryset.order_by()[:cap + 1].count()
+        return cache.get_or_set(self.key('count', cap), lambda: shared.order_by()[:cap + 1].count(),
+                                settings.SEARCH_CACHE_TIMEOUT)
 
-            for event in event_list:
-                destinations = destinations + str(
-                    event.location_number) + " " + event.location_street + ", " + event.location_city + "|"
+    def facets(self, queryset: QuerySet, shared: QuerySet) -> dict:
+        if self.user.is_authenticated:
+            # per user, their own enrollments show up in the counts when the timeout expires
+            return cache.get_or_set(self.key('facets', self.user.pk), lambda: EventSelector().facets(queryset),
+                                    settings.SEARCH_CACHE_TIMEOUT)
+        return cache.get_or_set(self.key('facets'), lambda: EventSelector().facets(shared),
+                                settings.SEARCH_CACHE_TIMEOUT)
 
-            distancematrix = gmaps.distance_matrix(origins, destinations)
+    def rows(self, queryset: QuerySet, shared: QuerySet, limit: int, *parts) -> list:
+        key = self.key(limit, *parts)
+        pks = cache.get(key)
+        if pks is None:
+            pks = list(shared.values_list('pk', flat=True)[:limit + self.slack])
+            cache.set(key, pks, settings.SEARCH_CACHE_TIMEOUT)
 
-            for element, event in zip(distancematrix['rows'][0]['elements'], event_list):
-                if element['status'] == 'OK':
-                    events_distances[event] = element['distance']['value']
+        # the queryset applies every filter again, so stale pks are only left out
+        events = queryset.in_bulk(pks)
+        rows = [events[pk] for pk in pks if pk in events]
+        if len(rows) < limit and len(pks) == limit + self.slack:
+            return list(queryset[:limit])
+        return rows[:limit]
 
-        events_distances_oredered = OrderedDict(
-            sorted(events_distances.items(), key=itemgetter(1), reverse=False))
 
-        return events_distances_oredered
+def normalize(value) -> str:
+    return ' '.join(str(value or '').lower().split())
 
 
 class RatingSelector:
     def on_user(self, reviewed: User, on='HOST') -> QuerySet:
         return models.Rating.objects.filter(reviewed=reviewed, on=on)
 
+    def on_user_with_authors(self, reviewed: User, on='HOST') -> QuerySet:
+        return self.on_user(reviewed, on).select_related('created_by__profile')
+
+    def by_user_on_events(self, created_by: User, events, on='HOST') -> dict:
+        ratings = models.Rating.objects.filter(created_by=created_by, event__in=events, on=on)
+        return {rating.event_id: rating for rating in ratings}
+
+    def by_user_on_attendees(self, created_by: User, event_pk: int, attendees) -> dict:
+        ratings = models.Rating.objects.filter(
+            created_by=created_by, event=event_pk, reviewed__in=attendees, on='ATTENDEE')
+        return {rating.reviewed_id: rating for rating in ratings}
+
     def exists_this_rating_for_this_user_and_event(self, created_by: User, event: models.Event,
                                                    reviewed: User) -> QuerySet:
         exists = models.Rating.objects.filter(created_by=created_by, event=event,
@@ -169,4 +284,4 @@ class TransactionSelector:
 
 class MessageSelector:
     def last_message(self) -> models.Message:
-        return models.Message.objects.latest()
+        return models.Message.objects.last()
@@ -1,32 +1,99 @@
+import contextvars
 import googlemaps
+import hashlib
+import json
 import pytz
 import stripe
+import tempfile
 
-from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import date, datetime, timedelta
+from enum import Enum
+from io import BytesIO
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection
 from django.core.exceptions import PermissionDenied
-from django.db import transaction as db_transaction
-from django.db.models import F, Subquery, OuterRef
+from django.core.files import File
+from django.db import IntegrityError, connections, transaction as db_transaction
+from django.db.models import Count, F, FloatField, IntegerField, Max, Q, QuerySet, Subquery, Sum, OuterRef
+from django.db.models.functions import Cast, Coalesce, Round
+from django.template.loader import get_template
 from django.utils.timezone import now
+from xhtml2pdf import pisa
 
+from . import caches
 from . import models
 from . import selectors
+from .backends import get_export_storage
+from .cities import NO_CITY, CityIndex
 
 User = get_user_model()
 
+# Stripe keeps the idempotency keys for 24 hours, a payout claim expires long before
+PAYOUT_CLAIM_TIMEOUT = timedelta(minutes=15)
+
 
 class EmailService:
     def send_email(self, subject: str, body: str, recipient_list: list):
-        send_mail(
-            subject,
-            body,
-            settings.EMAIL_HOST_USER,
-            recipient_list,
-            fail_silently=False,
-        )
+        # queued in the outbox, delivered later by the send_emails command
+        # subjects are built from event titles, line breaks are not allowed in a header
+        subject = ' '.join(subject.split())[:250]
+        models.OutboxEmail.objects.bulk_create([
+            models.OutboxEmail(subject=subject, body=body, recipient=recipient)
+            for recipient in recipient_list if recipient
+        ])
+
+    def deliver_outbox(self, batch_size=100) -> int:
+        with db_transaction.atomic():
+            # other workers skip the rows locked by this batch
+            emails = list(models.OutboxEmail.objects.select_for_update(skip_locked=True).filter(
+                sent_at__isnull=True, next_attempt_at__lte=now()).order_by('next_attempt_at')[:batch_size])
+            if not emails:
+                return 0
+
+            connection = get_connection()
+            try:
+                connection.open()
+                for email in emails:
+                    message = EmailMessage(
+                        email.subject, email.body, settings.EMAIL_HOST_USER, [email.recipient], connection=connection)
+                    try:
+                        message.send()
+                        email.sent_at = now()
+                    except Exception as error:
+                        # one email that can not be sent must not roll back the ones already sent
+                        self.retry_later(email, error)
+            except Exception as error:
+                for email in emails:
+                    if email.sent_at is None:
+                        self.retry_later(email, error)
+            finally:
+                connection.close()
+
+            models.OutboxEmail.objects.bulk_update(
+                emails, ['sent_at', 'attempts', 'next_attempt_at', 'last_error'])
+        return len(emails)
+
+    def retry_later(self, email: models.OutboxEmail, error: Exception):
+        email.attempts += 1
+        email.last_error = str(error)
+        if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+            email.next_attempt_at = None
+        else:
+            email.next_attempt_at = now() + timedelta(minutes=2 ** email.attempts)
+
+
+class Admission(Enum):
+    ADMITTED = 'ADMITTED'
+    ALREADY_ENROLLED = 'ALREADY_ENROLLED'
+    FULL = 'FULL'
+    NOT_FOUND = 'NOT_FOUND'
+    OWNER = 'OWNER'
+    STARTED = 'STARTED'
+    UNDERAGE = 'UNDERAGE'
 
 
 class EnrollmentService:
@@ -50,11 +117,46 @@ class EnrollmentService:
             pk=enrollment_pk).event.created_by
         return host == created_by
 
-    def update(self, enrollment_pk: int, updated_by: User, status: str):
-        enrollment = models.Enrollment.objects.get(pk=enrollment_pk)
-        enrollment.status = status
-        enrollment.updated_by = updated_by
-        enrollment.save()
+    def admit(self, event_pk: int, attendee: User):
+        attendee_age = attendee.profile.age
+        with db_transaction.atomic():
+            event = models.Event.objects.select_for_update().filter(pk=event_pk).first()
+            if event is None:
+                return Admission.NOT_FOUND, None
+            elif event.created_by_id == attendee.pk:
+                return Admission.OWNER, None
+            elif event.min_age > attendee_age:
+                return Admission.UNDERAGE, None
+            elif event.has_started:
+                return Admission.STARTED, None
+            elif event.is_full:
+                return Admission.FULL, None
+
+            try:
+                # the (event, created_by) unique constraint rejects duplicates
+                with db_transaction.atomic():
+                    enrollment = models.Enrollment.objects.create(
+                        created_by=attendee, event=event)
+            except IntegrityError:
+                return Admission.ALREADY_ENROLLED, None
+        return Admission.ADMITTED, enrollment
+
+    def update(self, enrollment_pk: int, updated_by: User, status: str) -> bool:
+        with db_transaction.atomic():
+            enrollment = models.Enrollment.objects.select_for_update().get(pk=enrollment_pk)
+            accepted_change = (status == 'ACCEPTED') - enrollment.is_accepted
+            if accepted_change:
+                events = models.Event.objects.filter(pk=enrollment.event_id)
+                if accepted_change > 0:
+                    # accepting never goes over the capacity, even with concurrent hosts
+                    events = events.filter(accepted_count__lt=F('capacity'))
+                if not events.update(accepted_count=F('accepted_count') + accepted_change):
+                    return False
+
+            enrollment.status = status
+            enrollment.updated_by = updated_by
+            enrollment.save()
+        return True
 
     def user_can_enroll(self, event_pk: int, user: User) -> bool:
         user_is_enrolled = self.user_is_enrolled(
@@ -103,7 +205,9 @@ class EventService():
     def update(self, event: models.Event, updated_by: User):
         event.updated_by = updated_by
         event.full_clean()
-        event.save()
+        # a stale copy of the event must not write back the maintained fields
+        event.save(update_fields=[field.name for field in event._meta.concrete_fields if not (
+            field.primary_key or field.name in event.MAINTAINED_FIELDS or field.name in ('created_at', 'created_by'))])
 
     def user_is_owner(self, host: User, event_pk: int) -> bool:
         return models.Event.objects.filter(created_by=host, pk=event_pk).exists()
@@ -116,22 +220,104 @@ class EventService():
         exist = models.Event.objects.filter(id=event_id).exists()
         return exist
 
-    def locations(self):
-        locations = models.Event.objects.values_list(
-            'location_city', flat=True).order_by('location_city').distinct('location_city').exclude(location_city='No disponible')
-        return locations
+    def city_index(self) -> CityIndex:
+        return caches.city_index.get(lambda: CityIndex(
+            models.Event.objects.exclude(location_city=NO_CITY).order_by().values_list(
+                'location_city').annotate(Count('pk'))))
 
     def can_update(self, event_pk):
         event = models.Event.objects.get(pk=event_pk)
 
         return event.can_update
 
+    def reconcile_accepted_counts(self, events=None) -> int:
+        if events is None:
+            events = models.Event.objects.all()
+        accepted = models.Enrollment.objects.filter(
+            event=OuterRef('pk'), status='ACCEPTED').order_by().values('event')
+        actual_count = Coalesce(Subquery(
+            accepted.annotate(total=Count('pk')).values('total')), 0)
+        drifted = events.annotate(actual_count=actual_count).exclude(
+            accepted_count=F('actual_count'))
+        return drifted.update(accepted_count=actual_count)
+
 
 class ProfileService():
     def create(self, user: User, birthdate: date, points: int):
-        profile = models.Profile.objects.create(
-            user=user, birthdate=birthdate, eventpoints=points)
-        profile.save()
+        with db_transaction.atomic():
+            models.Profile.objects.create(
+                user=user, birthdate=birthdate, eventpoints=0)
+            if points:
+                EventpointsService().credit(user, points, 'SIGNUP')
+
+
+class EventpointsService:
+    def record(self, entries: list):
+        # the entries and the balances they move are written together, the balances with relative updates
+        totals = {}
+        for entry in entries:
+            totals[entry.user_id] = totals.get(entry.user_id, 0) + entry.points
+        if not totals:
+            return
+        with db_transaction.atomic():
+            models.EventpointsEntry.objects.bulk_create(entries)
+            with connections[models.Profile.objects.db].cursor() as cursor:
+                cursor.execute(
+                    'UPDATE events_profile SET eventpoints = eventpoints + totals.points '
+                    'FROM unnest(%s::integer[], %s::integer[]) totals (user_id, points) '
+                    'WHERE events_profile.user_id = totals.user_id',
+                    [list(totals.keys()), list(totals.values())])
+
+    def credit(self, user: User, points: int, reason: str, transaction: models.Transaction = None):
+        self.record([models.EventpointsEntry(
+            user=user, points=points, reason=reason, transaction=transaction)])
+        if User.profile.is_cached(user):
+            user.profile.eventpoints += points
+
+    def debit(self, user: User, points: int, reason: str, transaction: models.Transaction = None) -> int:
+        # never below zero, returns the points actually debited
+        with db_transaction.atomic():
+            balance = models.Profile.objects.select_for_update().values_list(
+                'eventpoints', flat=True).get(user=user)
+            points = min(max(0, points), balance)
+            if points:
+                self.record([models.EventpointsEntry(
+                    user=user, points=-points, reason=reason, transaction=transaction)])
+        user.profile.eventpoints = balance - points
+        return points
+
+    def bonuses(self, transactions) -> dict:
+        # the bonus points still credited for every transaction pk, with the user that earned them
+        bonuses = models.EventpointsEntry.objects.filter(
+            transaction__in=transactions, reason='BONUS').order_by().values(
+            'transaction', 'user').annotate(points=Sum('points')).filter(points__gt=0)
+        return {bonus['transaction']: (bonus['user'], bonus['points']) for bonus in bonuses}
+
+    def take_back_bonuses(self, transactions):
+        # the charges that failed or were refunded do not keep their bonus, the entries are compensated
+        self.record([models.EventpointsEntry(
+            user_id=user_id, points=-points, reason='BONUS', transaction_id=transaction_id)
+            for transaction_id, (user_id, points) in self.bonuses(transactions).items()])
+
+    def open_ledgers(self) -> int:
+        # the balances without entries, as loaded by fixtures, become opening entries
+        profiles = models.Profile.objects.exclude(eventpoints=0).exclude(
+            user__eventpoints_entries__isnull=False)
+        entries = models.EventpointsEntry.objects.bulk_create(
+            models.EventpointsEntry(user_id=user_id, points=points, reason='OPENING')
+            for user_id, points in profiles.values_list('user', 'eventpoints'))
+        return len(entries)
+
+    def reconcile(self, profiles=None) -> int:
+        if profiles is None:
+            profiles = models.Profile.objects.all()
+        entries = models.EventpointsEntry.objects.filter(
+            user=OuterRef('user')).order_by().values('user')
+        balance = Coalesce(Subquery(
+            entries.annotate(total=Sum('points')).values('total')), 0)
+        drifted = profiles.annotate(balance=balance).exclude(
+            eventpoints=F('balance'))
+        return drifted.update(eventpoints=balance)
 
 
 class RatingService:
@@ -141,7 +327,29 @@ class RatingService:
 
     def create(self, rating: models.Rating):
         rating.full_clean()
-        rating.save()
+        count_field, sum_field = models.Rating.score_fields(rating.on)
+        with db_transaction.atomic():
+            rating.save()
+            models.Profile.objects.filter(user=rating.reviewed).update(**{
+                count_field: F(count_field) + 1,
+                sum_field: F(sum_field) + rating.score
+            })
+
+    def rebuild_scores(self, users=None) -> int:
+        profiles = models.Profile.objects.all()
+        if users is not None:
+            profiles = profiles.filter(user__in=users)
+
+        scores = {}
+        for on, _ in models.Rating.ON_CHOICES:
+            count_field, sum_field = models.Rating.score_fields(on)
+            ratings = models.Rating.objects.filter(
+                reviewed=OuterRef('user'), on=on).order_by().values('reviewed')
+            scores[count_field] = Coalesce(Subquery(
+                ratings.annotate(total=Count('pk')).values('total')), 0)
+            scores[sum_field] = Coalesce(Subquery(
+                ratings.annotate(total=Sum('score')).values('total')), 0)
+        return profiles.update(**scores)
 
     def is_valid_rating(self, rating: models.Rating, event: models.Event, user: User):
         rating.created_by = user
@@ -169,6 +377,9 @@ class RatingService:
 
 
 class PaymentService():
+    def __init__(self, client=stripe):
+        self.client = client
+
     def fee(self, amount_host: int) -> int:
         res = 0
         const_stripe = 25
@@ -212,8 +423,9 @@ class PaymentService():
             res = (amount_host + amount_company) * var_stripe + const_stripe
         return int(round(res - amount_host, 2))
 
-    def charge_connect(self, amount: int, customer_id: int, application_fee_amount: int, host: User) -> None:
-        stripe.Charge.create(
+    def charge_connect(self, amount: int, customer_id: int, application_fee_amount: int, host: User,
+                       idempotency_key=None, metadata=None) -> stripe.Charge:
+        return self.client.Charge.create(
             amount=amount,
             currency='eur',
             customer=customer_id,
@@ -221,59 +433,270 @@ class PaymentService():
             application_fee_amount=application_fee_amount,
             destination={
                 'account': host.profile.stripe_user_id,
-            }
+            },
+            idempotency_key=idempotency_key,
+            metadata=metadata
         )
 
     def charge(self, amount: int, source: str) -> None:
-        stripe.Charge.create(
+        self.client.Charge.create(
             amount=amount,
             currency='eur',
             description='A event payment',
             source=source
         )
 
-    def save_transaction(self, amount: int, fee: int, customer_id: int, event: models.Event, created_by: User, recipient: User, discount=0):
-        models.Transaction.objects.create(amount=amount, fee=fee, created_by=created_by, recipient=recipient,
+    def save_transaction(self, amount: int, fee: int, customer_id: int, event: models.Event, created_by: User, recipient: User, discount=0) -> models.Transaction:
+        return models.Transaction.objects.create(amount=amount, fee=fee, created_by=created_by, recipient=recipient,
                                           customer_id=customer_id, event=event, is_paid_for=False, discount=discount)
 
-    def get_or_create_customer(self, email: str, source: str) -> stripe.Customer:
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        connected_customers = stripe.Customer.list()
-        for customer in connected_customers:
-            if customer.email == email:
-                return customer
-        return stripe.Customer.create(
-            email=email,
-            source=source
-        )
+    def get_or_create_customer(self, user: User, source: str) -> str:
+        customer_id = self.customer_id(user)
+        if customer_id is None:
+            self.client.api_key = settings.STRIPE_SECRET_KEY
+            customer_id = self.client.Customer.create(
+                email=user.email,
+                source=source
+            ).id
+            self.save_customer(user, customer_id)
+        return customer_id
+
+    def customer_id(self, user: User) -> str:
+        # never asks Stripe, the customers created before the local index are linked by sync_stripe_customers
+        return user.profile.stripe_customer_id
+
+    def is_customer(self, user: User) -> bool:
+        return self.customer_id(user) is not None
+
+    def save_customer(self, user: User, customer_id: str):
+        models.Profile.objects.filter(user=user).update(
+            stripe_customer_id=customer_id)
+        user.profile.stripe_customer_id = customer_id
+
+    def sync_customers(self) -> int:
+        self.client.api_key = settings.STRIPE_SECRET_KEY
+        customer_ids = {}
+        for customer in self.client.Customer.list(limit=100).auto_paging_iter():
+            if customer.email:
+                customer_ids.setdefault(customer.email, customer.id)
+
+        profiles = list(models.Profile.objects.filter(
+            stripe_customer_id__isnull=True, user__email__in=customer_ids.keys()).select_related('user'))
+        for profile in profiles:
+            profile.stripe_customer_id = customer_ids[profile.user.email]
+        models.Profile.objects.bulk_update(
+            profiles, ['stripe_customer_id'], batch_size=500)
+        return len(profiles)
+
+
+class PayoutService:
+    def __init__(self, client=stripe, executor: ThreadPoolExecutor = None):
+        self.payment_service = PaymentService(client)
+        # the charges of every event paid out by this service share the executor, when given
+        self.executor = executor
+
+    def pay_event(self, event: models.Event):
+        # returns the paid and failed transactions, or None when another payout holds the event
+        paid = []
+        failed = []
+        with db_transaction.atomic():
+            # the event row is only locked while its transactions are claimed, not during the charges
+            event = models.Event.objects.select_for_update(skip_locked=True).filter(
+                pk=event.pk, is_paid_for=False).first()
+            if event is None or self.claimed_transactions(event).exists():
+                return None
+
+            transactions = self.pending_transactions(event)
+            models.Transaction.objects.filter(pk__in=[transaction.pk for transaction in transactions]).update(
+                payout_claimed_at=now())
+
+        with nullcontext(self.executor) if self.executor else ThreadPoolExecutor(
+                max_workers=settings.PAYOUT_MAX_WORKERS) as executor:
+            # the charges run in copies of this context, the request metrics count their calls to Stripe
+            context = contextvars.copy_context()
+            charges = executor.map(lambda transaction: context.copy().run(self.charge, transaction), transactions)
+            # every charge is recorded as it arrives, a payout interrupted halfway charges the
+            # rest again with the same idempotency keys
+            for transaction, charge in zip(transactions, charges):
+                if charge is None:
+                    models.Transaction.objects.filter(pk=transaction.pk).update(
+                        payout_claimed_at=None, payout_attempts=F('payout_attempts') + 1)
+                    failed.append(transaction)
+                else:
+                    # is_paid_for waits for the charge.succeeded webhook
+                    transaction.charge_id = charge.id
+                    self.record_charge(transaction)
+                    paid.append(transaction)
+
+        if not failed:
+            models.Event.objects.filter(pk=event.pk).update(is_paid_for=True)
+        return paid, failed
+
+    def record_charge(self, transaction: models.Transaction):
+        with db_transaction.atomic():
+            models.Transaction.objects.filter(pk=transaction.pk).update(charge_id=transaction.charge_id)
+            # a charge replayed by Stripe does not earn the bonus twice
+            if not transaction.discount and not EventpointsService().bonuses([transaction]):
+                EventpointsService().credit(
+                    transaction.created_by, UserService().bonus(transaction.amount), 'BONUS', transaction)
+
+    def claimed_transactions(self, event: models.Event) -> QuerySet:
+        return models.Transaction.objects.filter(
+            event=event, is_paid_for=False, charge_id__isnull=True,
+            payout_claimed_at__gt=now() - PAYOUT_CLAIM_TIMEOUT)
+
+    def pending_transactions(self, event: models.Event) -> list:
+        transactions = models.Transaction.objects.filter(
+            event=event,
+            is_paid_for=False,
+            charge_id__isnull=True,
+            created_by__in=selectors.UserSelector().event_attendees(event.pk)
+        ).select_related('created_by__profile', 'recipient__profile').order_by('-created_at')
+
+        # only the latest transaction of each attendee is charged
+        latest = {}
+        for transaction in transactions:
+            latest.setdefault(transaction.created_by_id, transaction)
+        return list(latest.values())
+
+    def charge(self, transaction: models.Transaction):
+        try:
+            return self.payment_service.charge_connect(
+                transaction.actual_amount, transaction.customer_id, transaction.discounted_fee,
+                transaction.recipient,
+                idempotency_key='payout-{0}-{1}'.format(transaction.id, transaction.payout_attempts),
+                metadata={'transaction': str(transaction.id)})
+        except stripe.error.StripeError:
+            return None
+
+
+class SettlementService:
+    def __init__(self, client=stripe):
+        self.client = client
+
+    def claim(self, batch_size=20) -> list:
+        # concurrent schedulers wait on the checkpoint and get consecutive batches
+        with db_transaction.atomic():
+            checkpoint, created = models.SettlementCheckpoint.objects.select_for_update().get_or_create(pk=1)
+            events = selectors.EventSelector().unsettled()
+            if checkpoint.event_id is not None:
+                events = events.filter(Q(ends_at__gt=checkpoint.ends_at) |
+                                       Q(ends_at=checkpoint.ends_at, pk__gt=checkpoint.event_id))
+            events = list(events.order_by('ends_at', 'pk')[:batch_size])
+            if events:
+                checkpoint.ends_at, checkpoint.event_id = events[-1].ends_at, events[-1].pk
+            else:
+                # the pass is over, the next one starts again with the events that failed
+                checkpoint.ends_at = checkpoint.event_id = None
+            checkpoint.updated_at = now()
+            checkpoint.save()
+        return events
+
+    def settle(self, events: list, workers=4) -> tuple:
+        # returns the number of events paid out, failed and skipped because another payout holds them
+        with ThreadPoolExecutor(max_workers=settings.PAYOUT_MAX_WORKERS) as charges:
+            # at most PAYOUT_MAX_WORKERS calls to Stripe at a time, whatever the number of workers
+            payout_service = PayoutService(self.client, charges)
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(self.settle_in_thread, [payout_service] * len(events), events))
+            else:
+                results = [payout_service.pay_event(event) for event in events]
+        skipped = results.count(None)
+        failed = sum(1 for result in results if result is not None and result[1])
+        return len(results) - failed - skipped, failed, skipped
+
+    def settle_in_thread(self, payout_service: PayoutService, event: models.Event):
+        try:
+            return payout_service.pay_event(event)
+        finally:
+            # every worker thread opens its own connection
+            connections.close_all()
+
+
+class StripeEventService:
+    def receive(self, payload: bytes, signature: str):
+        # raises ValueError or stripe.error.SignatureVerificationError when Stripe did not sign the payload
+        event = stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+        # Stripe delivers an event again until it is acknowledged, the copies are ignored
+        models.StripeEvent.objects.bulk_create([models.StripeEvent(
+            id=event['id'], type=event['type'], payload=json.loads(payload))], ignore_conflicts=True)
+
+    def process_inbox(self, batch_size=100) -> int:
+        with db_transaction.atomic():
+            # other workers skip the rows locked by this batch
+            events = list(models.StripeEvent.objects.select_for_update(skip_locked=True).filter(
+                processed_at__isnull=True, next_attempt_at__lte=now()).order_by('next_attempt_at')[:batch_size])
+            for event in events:
+                try:
+                    with db_transaction.atomic():
+                        self.process(event)
+                    event.processed_at = now()
+                except Exception as error:
+                    # a payload that cannot be applied must not hold back the rest of the inbox
+                    self.retry_later(event, error)
+            models.StripeEvent.objects.bulk_update(
+                events, ['processed_at', 'attempts', 'next_attempt_at', 'last_error'])
+        return len(events)
+
+    def process(self, event: models.StripeEvent):
+        handler = getattr(self, 'on_' + event.type.replace('.', '_'), None)
+        if handler is not None:
+            handler(event.data)
+
+    def retry_later(self, event: models.StripeEvent, error: Exception):
+        event.attempts += 1
+        event.last_error = repr(error)
+        if event.attempts >= settings.STRIPE_EVENT_MAX_ATTEMPTS:
+            event.next_attempt_at = None
+        else:
+            event.next_attempt_at = now() + timedelta(minutes=2 ** event.attempts)
 
-    def is_customer(self, email: str) -> bool:
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        connected_customers = stripe.Customer.list()
-        for customer in connected_customers:
-            if customer.email == email:
-                return True
+    def charged_transactions(self, charge: dict) -> QuerySet:
+        # the payouts name their transaction, the webhook can arrive before pay_event stores the charge id
+        transactions = Q(charge_id=charge['id'])
+        if charge.get('metadata', {}).get('transaction'):
+            transactions |= Q(pk=charge['metadata']['transaction'])
+        return models.Transaction.objects.filter(transactions)
 
-        return False
+    def on_charge_succeeded(self, charge: dict):
+        self.charged_transactions(charge).update(charge_id=charge['id'], is_paid_for=True)
+
+    def on_charge_failed(self, charge: dict):
+        transactions = self.charged_transactions(charge)
+        EventpointsService().take_back_bonuses(transactions)
+        # the settlement scheduler charges the event again, with the next idempotency key
+        models.Event.objects.filter(pk__in=transactions.values('event')).update(is_paid_for=False)
+        transactions.update(charge_id=None, is_paid_for=False, payout_claimed_at=None,
+                            payout_attempts=F('payout_attempts') + 1)
+
+    def on_charge_refunded(self, charge: dict):
+        transactions = self.charged_transactions(charge)
+        EventpointsService().take_back_bonuses(transactions)
+        transactions.update(is_paid_for=False)
+
+    def on_customer_deleted(self, customer: dict):
+        models.Profile.objects.filter(stripe_customer_id=customer['id']).update(stripe_customer_id=None)
 
 
 class UserService:
-    def add_bonus(self, user: User, price):
-        points = int(round((float(price) * 100 *
-                            settings.EVENTPOINT_BONUS) / settings.EVENTPOINT_VALUE))
-        user.profile.eventpoints += points
-        user.profile.save()
+    def bonus(self, price) -> int:
+        return int(round((float(price) * 100 *
+                          settings.EVENTPOINT_BONUS) / settings.EVENTPOINT_VALUE))
+
+    def add_bonus(self, user: User, price, transaction: models.Transaction = None):
+        EventpointsService().credit(user, self.bonus(price), 'BONUS', transaction)
 
     def add_eventpoints(self, token: str) -> int:
         points = 0
         user = selectors.UserSelector().with_token(token)
         if user:
             points = settings.EVENTPOINTS
-            user.profile.eventpoints += points
-            user.profile.save()
+            EventpointsService().credit(user, points, 'REFERRAL')
         return points
 
-    def return_eventpoints(self, attendees, events):
+    def return_eventpoints(self, attendees, events) -> dict:
+        # returns the eventpoints given back to every user pk
         with db_transaction.atomic():
             if isinstance(attendees, User):
                 attendees = [attendees]
@@ -284,23 +707,129 @@ class UserService:
                 events = [events]
 
             transactions = selectors.TransactionSelector().users_on_events(attendees, events)
-            discounts = transactions.filter(
-                discount__gt=0).values_list('created_by', 'discount')
-            for pk, discount in discounts:
-                returned = int(
-                    round(discount/settings.EVENTPOINT_VALUE/settings.STRIPE_VARIABLE_FEE))
-                models.Profile.objects.filter(user__pk=pk).update(
-                    eventpoints=F('eventpoints')+returned)
+            # rounded per transaction, as they were discounted
+            returned = Cast(Round(Cast('discount', FloatField()) / settings.EVENTPOINT_VALUE /
+                                  settings.STRIPE_VARIABLE_FEE), IntegerField())
+            refunds = transactions.filter(discount__gt=0).order_by().values(
+                'created_by').annotate(points=Sum(returned))
+            sql, params = refunds.query.sql_with_params()
+            with connections[refunds.db].cursor() as cursor:
+                cursor.execute(
+                    'UPDATE events_profile SET eventpoints = eventpoints + refunds.points '
+                    'FROM ({0}) refunds WHERE events_profile.user_id = refunds.created_by_id '
+                    'RETURNING events_profile.user_id, refunds.points'.format(sql), params)
+                refunded = dict(cursor.fetchall())
+            # the balances are already moved, only the entries are left to write
+            models.EventpointsEntry.objects.bulk_create(
+                models.EventpointsEntry(user_id=user_id, points=points, reason='REFUND')
+                for user_id, points in refunded.items())
             transactions.delete()
+        return refunded
 
     def exist_user(self, user_id: int) -> bool:
         exist = models.User.objects.filter(id=user_id).exists()
         return exist
 
 
+class ExportService:
+    def data_version(self, user: User) -> str:
+        relations = {
+            'events': models.Event.objects.filter(created_by=OuterRef('pk')),
+            'enrollments': models.Enrollment.objects.filter(created_by=OuterRef('pk')),
+            'ratings': models.Rating.objects.filter(created_by=OuterRef('pk')),
+            'transactions': models.Transaction.objects.filter(created_by=OuterRef('pk')),
+        }
+        summaries = {}
+        for name, queryset in relations.items():
+            queryset = queryset.order_by().values('created_by')
+            summaries[name + '_count'] = Subquery(
+                queryset.annotate(total=Count('pk')).values('total'))
+            summaries[name + '_updated_at'] = Subquery(
+                queryset.annotate(last=Max('updated_at')).values('last'))
+
+        data = User.objects.filter(pk=user.pk).values(
+            'first_name', 'last_name', 'email', 'profile__location', 'profile__picture', 'profile__birthdate',
+            'profile__eventpoints', 'profile__bio', **summaries).get()
+        return hashlib.sha1(repr(sorted(data.items())).encode('utf-8')).hexdigest()
+
+    def request_export(self, user: User) -> models.DataExport:
+        export, created = models.DataExport.objects.get_or_create(
+            user=user, version=self.data_version(user))
+        return export
+
+    def open(self, export: models.DataExport):
+        return get_export_storage().open(export.file_name, 'rb')
+
+    def render_pending(self, batch_size=10) -> int:
+        with db_transaction.atomic():
+            exports = list(models.DataExport.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+                status='PENDING', next_attempt_at__lte=now()).select_related(
+                'user__profile').order_by('next_attempt_at')[:batch_size])
+            for export in exports:
+                try:
+                    with db_transaction.atomic():
+                        self.render(export)
+                except Exception:
+                    # an export that can not be rendered must not roll back the rest of the batch
+                    export.status, export.file_name, export.finished_at = 'PENDING', None, None
+                    self.retry_later(export)
+                    export.save()
+        return len(exports)
+
+    def render(self, export: models.DataExport):
+        html = get_template('profile/pdf.html').render(
+            self.export_context(export.user))
+        with tempfile.TemporaryFile() as pdf_file:
+            pdf = pisa.pisaDocument(
+                BytesIO(html.encode('ISO-8859-1', 'xmlcharrefreplace')), pdf_file)
+            if pdf.err:
+                self.retry_later(export)
+            else:
+                pdf_file.seek(0)
+                export.file_name = get_export_storage().save(
+                    'exports/{0}/{1}.pdf'.format(export.user_id, export.version), File(pdf_file))
+                export.status = 'DONE'
+                export.finished_at = now()
+        export.save()
+
+        if export.is_done:
+            # the older versions can not be downloaded anymore, the newer ones are still to render
+            for outdated in models.DataExport.objects.filter(
+                    user=export.user_id, created_at__lt=export.created_at):
+                outdated.delete()
+
+    def retry_later(self, export: models.DataExport):
+        export.attempts += 1
+        if export.attempts >= settings.EXPORT_MAX_ATTEMPTS:
+            export.status = 'FAILED'
+            export.finished_at = now()
+            export.next_attempt_at = None
+        else:
+            export.next_attempt_at = now() + timedelta(minutes=2 ** export.attempts)
+
+    def export_context(self, user: User) -> dict:
+        profile = user.profile
+        return {
+            'name': user.first_name,
+            'last_name': user.last_name,
+            'email': user.email,
+            'date_join': user.date_joined,
+            'location': profile.location,
+            'picture': profile.picture,
+            'birthdate': profile.birthdate,
+            'token': profile.token,
+            'eventpoints': profile.eventpoints,
+            'bio': profile.bio,
+            'events': selectors.EventSelector().hosted(user).select_related('created_by'),
+            'enrollments': models.Enrollment.objects.filter(
+                created_by=user).select_related('created_by', 'event'),
+            'ratings': models.Rating.objects.filter(
+                created_by=user).select_related('created_by', 'event', 'reviewed'),
+            'transactions': models.Transaction.objects.filter(
+                created_by=user).select_related('created_by', 'recipient'),
+        }
+
+
 class MessageService:
     def last_message(self):
-        message = None
-        if models.Message.objects.all():
-            message = selectors.MessageSelector().last_message()
-        return message
+        return caches.last_message.get(selectors.MessageSelector().last_message)
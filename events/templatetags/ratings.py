@@ -7,11 +7,16 @@ register = template.Library()
 User = get_user_model()
 
 
-@register.simple_tag
-def user_on_event_host(user: User, event: Event) -> Rating:
+@register.simple_tag(takes_context=True)
+def user_on_event_host(context, user: User, event: Event) -> Rating:
+    # the lists load the ratings of the whole page at once
+    if 'user_ratings' in context:
+        return context['user_ratings'].get(event.pk)
     return Rating.objects.filter(created_by=user, event=event).first()
 
 
-@register.simple_tag
-def user_on_event_on_attendee(user: User, event: Event, attendee: User) -> Rating:
+@register.simple_tag(takes_context=True)
+def user_on_event_on_attendee(context, user: User, event: Event, attendee: User) -> Rating:
+    if 'attendee_ratings' in context:
+        return context['attendee_ratings'].get(attendee.pk)
     return Rating.objects.filter(created_by=user, event=event, reviewed=attendee).first()
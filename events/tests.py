@@ -1,3 +1,977 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import math
+import re
+import smtplib
+import tempfile
 
-# Create your tests here.
+from datetime import date, time, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+import stripe
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.db import transaction as db_transaction
+from django.db.models import F, QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, reverse
+from django.utils.timezone import now
+
+from events import caches
+from events import forms
+from events import models
+from events import selectors
+from events import services
+from events import urls
+from events.backends import LocalGeocoderBackend
+from events.middleware import RequestMetrics
+from events.pagination import KeysetPaginator
+
+User = get_user_model()
+
+# Maximum number of SQL queries per GET of each view in events/urls.py, or per POST of the views that
+# only take POST, new views must declare theirs
+QUERY_BUDGETS = {
+    'about_us': 3,
+    'attendee_payment': 5,
+    'authorize': 5,
+    'authorize_callback': 2,
+    'city_autocomplete': 1,
+    'create_event': 3,
+    'create_rating_attendee': 9,
+    'create_rating_host': 7,
+    'delete_enrollment': 13,
+    'delete_event': 9,
+    'delete_profile': 4,
+    'detail_event': 7,
+    'detail_profile': 3,
+    'enroll_event': 8,
+    'enrolled_events': 4,
+    'event_filter': 3,
+    'home': 4,
+    'hosted_events': 5,
+    'list_attendees': 7,
+    'list_enrollments': 9,
+    'list_event_filter': 7,
+    'not_impl': 3,
+    'payment_error': 3,
+    'pdf_download': 8,
+    'receipts': 4,
+    'referred': 3,
+    'signup': 3,
+    'stripe_webhook': 0,
+    'terms': 3,
+    'thanks': 3,
+    'update_enrollment': 20,
+    'update_event': 10,
+    'update_profile': 3,
+}
+
+# Sent by the views that only take POST
+POST_DATA = {
+    'update_enrollment': {'status': 'ACCEPTED'},
+}
+
+# Tables that grow with the site, the selectors must reach them through an index
+LARGE_TABLES = {'auth_user', 'events_enrollment', 'events_event',
+                'events_profile', 'events_rating', 'events_transaction'}
+
+
+def commit():
+    # TestCase never commits, runs the on_commit callbacks registered so far
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for savepoints, callback in callbacks:
+        callback()
+
+
+@override_settings(GEOCODER_BACKEND='events.backends.LocalGeocoderBackend')
+class EventshowTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.host = cls.create_user('host', stripe_user_id='acct_host', stripe_access_token='sk_host',
+                                   stripe_customer_id='cus_host')
+        cls.attendee = cls.create_user('attendee', stripe_customer_id='cus_attendee')
+        category = models.Category.objects.create(name='Juegos')
+        cls.event = models.Event.objects.create(
+            title='Noche de juegos', description='Juegos de mesa', picture='seed/event/game.png',
+            location_city='Sevilla', location_street='Calle Feria', location_number=1,
+            start_day=date.today() + timedelta(days=10), start_time=time(18, 0), end_time=time(21, 0),
+            price=5, capacity=4, min_age=16, lang='Español', pets=False, parking_nearby=True,
+            is_paid_for=False, created_by=cls.host, category=category)
+        cls.enrollment = models.Enrollment.objects.create(
+            event=cls.event, created_by=cls.attendee, status='PENDING')
+
+    @staticmethod
+    def create_user(username, **profile):
+        user = User.objects.create_user(username, username + '@eventshow.com', 'eventshow')
+        models.Profile.objects.create(user=user, birthdate=date(1990, 1, 1), **profile)
+        return user
+
+
+class QueryBudgetTests(EventshowTestCase):
+
+    def url_kwargs(self, pattern):
+        kwargs = {
+            'pk': self.enrollment.pk if 'enrollment' in pattern.name else self.event.pk,
+            'event_pk': self.event.pk,
+            'attendee_pk': self.attendee.pk,
+        }
+        return {name: kwargs[name] for name in pattern.pattern.regex.groupindex if name in kwargs}
+
+    def assertWithinQueryBudget(self, response, budget):
+        metrics = response.wsgi_request.metrics
+        self.assertLessEqual(metrics.queries, budget, '{0} ran {1} queries, its budget is {2}'.format(
+            metrics.view_name, metrics.queries, budget))
+        self.assertEqual(metrics.http_calls, 0, '{0} called external services'.format(metrics.view_name))
+
+    def test_every_view_declares_a_budget(self):
+        names = {pattern.name for pattern in urls.urlpatterns if isinstance(pattern, URLPattern)}
+        self.assertEqual(names - set(QUERY_BUDGETS), set())
+
+    def test_views_stay_within_budget(self):
+        self.client.force_login(self.host)
+        for pattern in urls.urlpatterns:
+            with self.subTest(pattern.name):
+                url = reverse(pattern.name, kwargs=self.url_kwargs(pattern))
+                response = self.client.get(url)
+                if response.status_code == 405:
+                    with db_transaction.atomic():
+                        # the changes a POST makes are not seen by the next views
+                        response = self.client.post(url, POST_DATA.get(pattern.name, {}))
+                        db_transaction.set_rollback(True)
+                self.assertNotEqual(response.status_code, 405)
+                self.assertIn('Server-Timing', response)
+                self.assertWithinQueryBudget(response, QUERY_BUDGETS[pattern.name])
+
+
+class CannedAdapter(requests.adapters.BaseAdapter):
+    # answers every request without leaving the process
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code, response.request, response.url = 200, request, request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class RequestMetricsTests(TestCase):
+
+    def test_http_calls_count_in_every_enclosing_metrics(self):
+        session = requests.Session()
+        session.mount('https://api.stripe.com', CannedAdapter())
+        outer, inner = RequestMetrics(), RequestMetrics()
+        with outer.collect():
+            with inner.collect():
+                session.get('https://api.stripe.com/v1/charges')
+            session.get('https://api.stripe.com/v1/customers')
+        session.get('https://api.stripe.com/v1/customers')
+        self.assertEqual((outer.http_calls, inner.http_calls), (2, 1))
+
+
+class EventUpdateTests(EventshowTestCase):
+
+    def test_updates_keep_the_maintained_fields(self):
+        event = models.Event.objects.get(pk=self.event.pk)
+        # an enrollment accepted and a payout finished while the host edits the event
+        models.Event.objects.filter(pk=event.pk).update(accepted_count=F('accepted_count') + 1, is_paid_for=True)
+
+        event.title = 'Noche de rol'
+        services.EventService().update(event, self.host)
+        event = models.Event.objects.get(pk=event.pk)
+        self.assertEqual((event.title, event.accepted_count, event.is_paid_for), ('Noche de rol', 1, True))
+        self.assertEqual(event.updated_by, self.host)
+
+
+class EventDetailTests(EventshowTestCase):
+
+    def test_detail_queries_do_not_depend_on_the_viewer(self):
+        url = reverse('detail_event', kwargs={'pk': self.event.pk})
+        for user, enrolled, owner in ((self.host, False, True), (self.attendee, True, False)):
+            with self.subTest(user.username):
+                self.client.force_login(user)
+                response = self.client.get(url)
+                self.assertEqual(response.context['user_is_enrolled'], enrolled)
+                self.assertEqual(response.context['user_is_owner'], owner)
+                self.assertLessEqual(response.wsgi_request.metrics.queries, QUERY_BUDGETS['detail_event'])
+
+    def test_missing_event_redirects_home(self):
+        self.assertRedirects(self.client.get(reverse('detail_event', kwargs={'pk': 0})), '/')
+
+
+class ProfileUpdateTests(EventshowTestCase):
+
+    def test_profile_edits_keep_the_eventpoints(self):
+        profile = models.Profile.objects.get(user=self.attendee)
+        # a referral credited while the attendee edits the profile
+        services.EventpointsService().credit(self.attendee, 30, 'REFERRAL')
+
+        form = forms.ProfileForm({'bio': 'Me gustan los juegos', 'birthdate': '01/01/1990', 'location': 'Sevilla'},
+                                 instance=profile)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save(self.attendee)
+        profile = models.Profile.objects.get(user=self.attendee)
+        self.assertEqual((profile.bio, profile.eventpoints), ('Me gustan los juegos', 30))
+
+    def test_connecting_stripe_keeps_the_rating_scores(self):
+        models.Profile.objects.filter(user=self.attendee).update(host_rating_count=2, host_rating_sum=9)
+        self.client.force_login(self.attendee)
+        session = self.client.session
+        session['usuario'] = self.attendee.pk
+        session.save()
+
+        token = SimpleNamespace(json=lambda: {'stripe_user_id': 'acct_attendee', 'access_token': 'sk_attendee'})
+        with mock.patch('events.views.requests.post', return_value=token), \
+                CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('authorize_callback'), {'code': 'ac_1'})
+        self.assertFalse([query for query in queries if 'host_rating_count' in query['sql']
+                          and query['sql'].startswith('UPDATE')])
+        profile = models.Profile.objects.get(user=self.attendee)
+        self.assertEqual((profile.stripe_user_id, profile.host_rating_count, profile.host_rating_sum),
+                         ('acct_attendee', 2, 9))
+
+
+class EnrolledListTests(EventshowTestCase):
+
+    def finished_enrollments(self, count):
+        for _ in range(count):
+            event = models.Event.objects.get(pk=self.event.pk)
+            event.pk = None
+            event.save()
+            models.Event.objects.filter(pk=event.pk).update(
+                start_day=date.today() - timedelta(days=3), starts_at=F('starts_at') - timedelta(days=13),
+                ends_at=F('ends_at') - timedelta(days=13))
+            models.Enrollment.objects.create(event=event, created_by=self.attendee, status='ACCEPTED')
+            models.Rating.objects.create(score=4, on='HOST', event=event, created_by=self.attendee,
+                                         reviewed=self.host)
+
+    def test_queries_do_not_grow_with_the_page(self):
+        self.client.force_login(self.attendee)
+        self.finished_enrollments(1)
+        queries = self.client.get(reverse('enrolled_events')).wsgi_request.metrics.queries
+
+        self.finished_enrollments(3)
+        response = self.client.get(reverse('enrolled_events'))
+        self.assertEqual(len(response.context['object_list']), 5)
+        self.assertEqual(response.wsgi_request.metrics.queries, queries)
+        self.assertContains(response, '<em class="rating-search">4</em>', count=4)
+
+
+class ReturnEventpointsTests(EventshowTestCase):
+
+    def transaction(self, event, discount):
+        return models.Transaction.objects.create(
+            event=event, created_by=self.attendee, recipient=self.host, amount=500, discount=discount, fee=40,
+            customer_id='cus_attendee', is_paid_for=False)
+
+    def test_refunds_every_discount_in_one_update(self):
+        other = models.Event.objects.get(pk=self.event.pk)
+        other.pk = None
+        other.save()
+        self.transaction(self.event, 20)
+        self.transaction(other, 7)
+        self.transaction(other, 0)
+
+        # the update, the refund entries and the delete, inside a savepoint
+        with self.assertNumQueries(5):
+            refunded = services.UserService().return_eventpoints(
+                User.objects.filter(pk=self.attendee.pk), [self.event, other])
+        # 20 / 0.5 / 1.029 and 7 / 0.5 / 1.029, rounded one by one
+        self.assertEqual(refunded, {self.attendee.pk: 39 + 14})
+        self.assertEqual(models.Profile.objects.get(user=self.attendee).eventpoints, 53)
+        self.assertFalse(models.Transaction.objects.exists())
+        self.assertEqual(list(models.EventpointsEntry.objects.values_list('user', 'points', 'reason')),
+                         [(self.attendee.pk, 53, 'REFUND')])
+
+
+class EventpointsLedgerTests(EventshowTestCase):
+
+    def balance(self, user):
+        return models.Profile.objects.get(user=user).eventpoints
+
+    def test_credits_and_debits_move_the_balance_with_an_entry(self):
+        service = services.EventpointsService()
+        attendee = User.objects.select_related('profile').get(pk=self.attendee.pk)
+        service.credit(attendee, 30, 'REFERRAL')
+        self.assertEqual(attendee.profile.eventpoints, 30)
+
+        # the debit is clamped to the balance
+        self.assertEqual(service.debit(attendee, 50, 'DISCOUNT'), 30)
+        self.assertEqual(attendee.profile.eventpoints, 0)
+        self.assertEqual(self.balance(attendee), 0)
+        self.assertEqual(list(models.EventpointsEntry.objects.order_by('pk').values_list('points', 'reason')),
+                         [(30, 'REFERRAL'), (-30, 'DISCOUNT')])
+
+    def test_record_updates_every_balance_at_once(self):
+        entries = [models.EventpointsEntry(user=user, points=points, reason='BONUS')
+                   for user, points in ((self.host, 5), (self.attendee, 7), (self.host, 3))]
+        with self.assertNumQueries(4):
+            services.EventpointsService().record(entries)
+        self.assertEqual(self.balance(self.host), 8)
+        self.assertEqual(self.balance(self.attendee), 7)
+
+    def test_reconcile_repairs_the_drifted_balances(self):
+        services.EventpointsService().credit(self.attendee, 12, 'BONUS')
+        models.Profile.objects.filter(user=self.attendee).update(eventpoints=99)
+        models.Profile.objects.filter(user=self.host).update(eventpoints=4)
+
+        self.assertEqual(services.EventpointsService().reconcile(), 2)
+        self.assertEqual(self.balance(self.attendee), 12)
+        self.assertEqual(self.balance(self.host), 0)
+
+
+class FakeStripe:
+    class Charge:
+        @staticmethod
+        def create(customer, idempotency_key, **kwargs):
+            if customer == 'cus_declined':
+                raise stripe.error.CardError('Your card was declined', None, 'card_declined')
+            return SimpleNamespace(id='ch_' + idempotency_key)
+
+
+class OutboxTests(EventshowTestCase):
+
+    def fail_delivery(self):
+        return mock.patch.object(services.EmailMessage, 'send', side_effect=smtplib.SMTPServerDisconnected('gone'))
+
+    def test_queued_emails_are_delivered_once(self):
+        services.EmailService().send_email('Evento cancelado', 'Lo sentimos', ['attendee@eventshow.com', ''])
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(services.EmailService().deliver_outbox(), 1)
+        self.assertEqual([(email.subject, email.to) for email in mail.outbox],
+                         [('Evento cancelado', ['attendee@eventshow.com'])])
+        self.assertIsNotNone(models.OutboxEmail.objects.get().sent_at)
+        self.assertEqual(services.EmailService().deliver_outbox(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_subjects_are_kept_on_one_line(self):
+        services.EmailService().send_email('Nueva inscripción a Noche\r\nde juegos', 'Hola', ['host@eventshow.com'])
+        self.assertEqual(models.OutboxEmail.objects.get().subject, 'Nueva inscripción a Noche de juegos')
+
+    def test_an_email_that_fails_does_not_hold_back_the_others(self):
+        services.EmailService().send_email('Evento cancelado', 'Lo sentimos', [
+            'attendee@eventshow.com', 'host@eventshow.com'])
+        with mock.patch.object(services.EmailMessage, 'send', side_effect=[ValueError('bad header'), 1]):
+            self.assertEqual(services.EmailService().deliver_outbox(), 2)
+        emails = models.OutboxEmail.objects.order_by('pk')
+        self.assertEqual([(email.sent_at is None, email.attempts) for email in emails], [(True, 1), (False, 0)])
+
+    def test_emails_are_queued_with_the_enrollment_change(self):
+        self.client.force_login(self.host)
+        with mock.patch.object(services.EmailService, 'send_email', side_effect=RuntimeError('outbox')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('update_enrollment', kwargs={'pk': self.enrollment.pk}),
+                                 {'status': 'ACCEPTED'})
+        self.assertEqual(models.Enrollment.objects.get(pk=self.enrollment.pk).status, 'PENDING')
+        self.assertEqual(models.Event.objects.get(pk=self.event.pk).accepted_count, 0)
+
+        self.client.post(reverse('update_enrollment', kwargs={'pk': self.enrollment.pk}), {'status': 'ACCEPTED'})
+        self.assertEqual(models.Enrollment.objects.get(pk=self.enrollment.pk).status, 'ACCEPTED')
+        self.assertEqual(models.OutboxEmail.objects.get().recipient, 'attendee@eventshow.com')
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_failed_emails_back_off_until_they_give_up(self):
+        services.EmailService().send_email('Evento cancelado', 'Lo sentimos', ['attendee@eventshow.com'])
+        with self.fail_delivery():
+            self.assertEqual(services.EmailService().deliver_outbox(), 1)
+        email = models.OutboxEmail.objects.get()
+        self.assertEqual((email.sent_at, email.attempts, email.last_error), (None, 1, 'gone'))
+        self.assertGreater(email.next_attempt_at, now() + timedelta(minutes=1))
+        # not retried before the backoff
+        self.assertEqual(services.EmailService().deliver_outbox(), 0)
+
+        models.OutboxEmail.objects.update(next_attempt_at=now())
+        with self.fail_delivery():
+            services.EmailService().deliver_outbox()
+        email.refresh_from_db()
+        self.assertEqual((email.attempts, email.next_attempt_at), (2, None))
+        self.assertEqual(services.EmailService().deliver_outbox(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class PaymentCustomerTests(EventshowTestCase):
+
+    def test_unknown_customers_are_not_looked_up_in_stripe(self):
+        newcomer = self.create_user('newcomer')
+        # any call to the client would fail
+        service = services.PaymentService(client=None)
+        self.assertFalse(service.is_customer(newcomer))
+        self.assertTrue(service.is_customer(self.attendee))
+
+
+class SettlementTests(EventshowTestCase):
+
+    def finished_event(self, days_ago, host=None):
+        event = models.Event.objects.get(pk=self.event.pk)
+        event.pk, event.created_by = None, host or self.host
+        event.start_day = date.today() - timedelta(days=days_ago)
+        event.save()
+        return event
+
+    def test_claims_the_finished_events_after_the_checkpoint(self):
+        older, newer = self.finished_event(3), self.finished_event(2)
+        # hosts without a connected account are not paid out
+        self.finished_event(1, host=self.attendee)
+
+        service = services.SettlementService(FakeStripe)
+        self.assertEqual(service.claim(1), [older])
+        self.assertEqual(service.claim(1), [newer])
+        self.assertEqual(service.claim(1), [])
+        # the next pass starts over
+        self.assertEqual(service.claim(5), [older, newer])
+
+    def test_settles_the_events_and_keeps_the_failed_ones(self):
+        paid, declined = self.finished_event(3), self.finished_event(2)
+        for event, customer_id in ((paid, 'cus_attendee'), (declined, 'cus_declined')):
+            models.Enrollment.objects.create(event=event, created_by=self.attendee, status='ACCEPTED')
+            models.Transaction.objects.create(
+                event=event, created_by=self.attendee, recipient=self.host, amount=500, discount=0, fee=40,
+                customer_id=customer_id, is_paid_for=False)
+
+        service = services.SettlementService(FakeStripe)
+        self.assertEqual(service.settle(service.claim(), workers=1), (1, 1, 0))
+        self.assertEqual(list(selectors.EventSelector().unsettled()), [declined])
+        transaction = models.Transaction.objects.get(event=paid)
+        # paid once the charge.succeeded webhook is processed
+        self.assertEqual(transaction.charge_id, 'ch_payout-{0}-0'.format(transaction.pk))
+        self.assertFalse(transaction.is_paid_for)
+        declined = models.Transaction.objects.get(event=declined)
+        # released for the next pass, charged then with a new idempotency key
+        self.assertEqual((declined.charge_id, declined.payout_claimed_at, declined.payout_attempts), (None, None, 1))
+
+    def paid_out_event(self):
+        event = self.finished_event(3)
+        models.Enrollment.objects.create(event=event, created_by=self.attendee, status='ACCEPTED')
+        transaction = models.Transaction.objects.create(
+            event=event, created_by=self.attendee, recipient=self.host, amount=500, discount=0, fee=40,
+            customer_id='cus_attendee', is_paid_for=False)
+        return event, transaction
+
+    def test_transactions_being_charged_hold_back_other_payouts(self):
+        event, transaction = self.paid_out_event()
+        models.Transaction.objects.filter(pk=transaction.pk).update(payout_claimed_at=now())
+
+        self.assertIsNone(services.PayoutService(FakeStripe).pay_event(event))
+        self.assertEqual(services.SettlementService(FakeStripe).settle([event], workers=1), (0, 0, 1))
+        self.assertFalse(models.Event.objects.get(pk=event.pk).is_paid_for)
+        self.assertIsNone(models.Transaction.objects.get(pk=transaction.pk).charge_id)
+
+    def test_interrupted_payouts_are_charged_again_with_the_same_key(self):
+        event, transaction = self.paid_out_event()
+        models.Transaction.objects.filter(pk=transaction.pk).update(
+            payout_claimed_at=now() - services.PAYOUT_CLAIM_TIMEOUT - timedelta(minutes=1))
+
+        paid, failed = services.PayoutService(FakeStripe).pay_event(event)
+        self.assertEqual(([charged.pk for charged in paid], failed), ([transaction.pk], []))
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.charge_id, 'ch_payout-{0}-0'.format(transaction.pk))
+        self.assertTrue(models.Event.objects.get(pk=event.pk).is_paid_for)
+        self.assertEqual(list(models.EventpointsEntry.objects.values_list('transaction', 'reason')),
+                         [(transaction.pk, 'BONUS')])
+
+    def test_the_charges_are_counted_by_the_request_metrics(self):
+        session = requests.Session()
+        session.mount('https://api.stripe.com', CannedAdapter())
+
+        class HttpStripe:
+            class Charge:
+                @staticmethod
+                def create(idempotency_key, **kwargs):
+                    session.post('https://api.stripe.com/v1/charges')
+                    return SimpleNamespace(id='ch_' + idempotency_key)
+
+        event, transaction = self.paid_out_event()
+        metrics = RequestMetrics()
+        with metrics.collect():
+            services.PayoutService(HttpStripe).pay_event(event)
+        self.assertEqual(metrics.http_calls, 1)
+
+    def test_failed_charges_take_back_their_bonus_and_are_charged_with_a_new_key(self):
+        event, transaction = self.paid_out_event()
+        services.PayoutService(FakeStripe).pay_event(event)
+        services.StripeEventService().on_charge_failed(
+            {'id': 'ch_payout-{0}-0'.format(transaction.pk), 'metadata': {'transaction': str(transaction.pk)}})
+        self.assertEqual(models.Profile.objects.get(user=self.attendee).eventpoints, 0)
+
+        services.PayoutService(FakeStripe).pay_event(event)
+        transaction.refresh_from_db()
+        self.assertEqual(transaction.charge_id, 'ch_payout-{0}-1'.format(transaction.pk))
+        # a charge replayed under the same key does not earn the bonus twice
+        services.PayoutService(FakeStripe).record_charge(transaction)
+        bonus = services.UserService().bonus(transaction.amount)
+        self.assertEqual(list(models.EventpointsEntry.objects.order_by('pk').values_list('points', flat=True)),
+                         [bonus, -bonus, bonus])
+        self.assertEqual(models.Profile.objects.get(user=self.attendee).eventpoints, bonus)
+
+
+def sign(payload, secret=None, timestamp=None):
+    # the Stripe-Signature header Stripe sends with every webhook
+    secret = secret or settings.STRIPE_WEBHOOK_SECRET
+    timestamp = timestamp or int(now().timestamp())
+    signature = hmac.new(secret.encode(), '{0}.{1}'.format(timestamp, payload).encode(), hashlib.sha256)
+    return 't={0},v1={1}'.format(timestamp, signature.hexdigest())
+
+
+def charge_event(event_id, event_type, charge_id, transaction=None):
+    # trimmed from the events the Stripe CLI records
+    return json.dumps({
+        'id': event_id,
+        'object': 'event',
+        'api_version': '2020-03-02',
+        'created': 1592211600,
+        'livemode': False,
+        'pending_webhooks': 1,
+        'request': {'id': 'req_Hd3kPqZ2n9Xa1C', 'idempotency_key': 'payout-{0}-0'.format(transaction)},
+        'type': event_type,
+        'data': {
+            'object': {
+                'id': charge_id,
+                'object': 'charge',
+                'amount': 560,
+                'application_fee_amount': 60,
+                'currency': 'eur',
+                'customer': 'cus_attendee',
+                'description': 'A event payment',
+                'metadata': {'transaction': str(transaction)} if transaction else {},
+                'paid': event_type == 'charge.succeeded',
+                'status': 'succeeded' if event_type == 'charge.succeeded' else 'failed',
+            },
+        },
+    })
+
+
+class StripeWebhookTests(EventshowTestCase):
+
+    def post(self, payload, signature=None):
+        return self.client.post(reverse('stripe_webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=signature or sign(payload))
+
+    def transaction(self, **kwargs):
+        return models.Transaction.objects.create(
+            event=self.event, created_by=self.attendee, recipient=self.host, amount=500, discount=0, fee=60,
+            customer_id='cus_attendee', is_paid_for=False, **kwargs)
+
+    def test_stores_every_signed_event_once(self):
+        payload = charge_event('evt_1', 'charge.succeeded', 'ch_1')
+        self.assertEqual(self.post(payload).status_code, 200)
+        self.assertEqual(self.post(payload).status_code, 200)
+        self.assertEqual(models.StripeEvent.objects.get().type, 'charge.succeeded')
+
+    def test_rejects_the_events_not_signed_with_the_secret(self):
+        payload = charge_event('evt_1', 'charge.succeeded', 'ch_1')
+        self.assertEqual(self.post(payload, sign(payload, 'whsec_other')).status_code, 400)
+        self.assertEqual(self.post(payload, 'garbage').status_code, 400)
+        self.assertFalse(models.StripeEvent.objects.exists())
+
+    def test_processing_updates_the_charged_transactions(self):
+        stored = self.transaction(charge_id='ch_1')
+        # the webhook arrived before pay_event stored the charge id
+        racing = self.transaction()
+        failed = self.transaction(charge_id='ch_3')
+        models.Event.objects.filter(pk=self.event.pk).update(is_paid_for=True)
+        for payload in (charge_event('evt_1', 'charge.succeeded', 'ch_1'),
+                        charge_event('evt_2', 'charge.succeeded', 'ch_2', racing.pk),
+                        charge_event('evt_3', 'charge.failed', 'ch_3', failed.pk),
+                        charge_event('evt_4', 'charge.dispute.created', 'ch_1')):
+            self.post(payload)
+
+        self.assertEqual(services.StripeEventService().process_inbox(), 4)
+        self.assertEqual(services.StripeEventService().process_inbox(), 0)
+        self.assertFalse(models.StripeEvent.objects.filter(processed_at__isnull=True).exists())
+        transactions = models.Transaction.objects.in_bulk([stored.pk, racing.pk, failed.pk])
+        self.assertTrue(transactions[stored.pk].is_paid_for)
+        self.assertEqual((transactions[racing.pk].charge_id, transactions[racing.pk].is_paid_for), ('ch_2', True))
+        self.assertEqual((transactions[failed.pk].charge_id, transactions[failed.pk].is_paid_for), (None, False))
+        # the settlement scheduler charges the event again
+        self.assertFalse(models.Event.objects.get(pk=self.event.pk).is_paid_for)
+
+    def test_a_failing_event_is_retried_without_blocking_the_inbox(self):
+        paid = self.transaction(charge_id='ch_2')
+        self.post(charge_event('evt_1', 'charge.succeeded', 'ch_1', 'not-a-uuid'))
+        self.post(charge_event('evt_2', 'charge.succeeded', 'ch_2'))
+
+        with override_settings(STRIPE_EVENT_MAX_ATTEMPTS=2):
+            self.assertEqual(services.StripeEventService().process_inbox(), 2)
+            self.assertTrue(models.Transaction.objects.get(pk=paid.pk).is_paid_for)
+            poison = models.StripeEvent.objects.get(pk='evt_1')
+            self.assertEqual((poison.processed_at, poison.attempts), (None, 1))
+            self.assertGreater(poison.next_attempt_at, now())
+
+            # given up after the last attempt
+            models.StripeEvent.objects.filter(pk='evt_1').update(next_attempt_at=now())
+            self.assertEqual(services.StripeEventService().process_inbox(), 1)
+            poison.refresh_from_db()
+            self.assertEqual((poison.attempts, poison.next_attempt_at), (2, None))
+            self.assertEqual(services.StripeEventService().process_inbox(), 0)
+
+
+class SelectorIndexTests(EventshowTestCase):
+
+    def assertNoSequentialScans(self, call):
+        with CaptureQueriesContext(connection) as queries:
+            result = call()
+            if isinstance(result, QuerySet):
+                list(result)
+
+        with connection.cursor() as cursor:
+            # on tables this small a sequential scan is always cheaper, so only
+            # the plans that have no index to use are left with one
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            for query in queries.captured_queries:
+                cursor.execute('EXPLAIN ' + query['sql'])
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                scanned = set(re.findall(r'Seq Scan on (\w+)', plan)) & LARGE_TABLES
+                self.assertFalse(scanned, 'Sequential scan on {0}:\n{1}\n{2}'.format(
+                    ', '.join(sorted(scanned)), query['sql'], plan))
+
+    def test_selectors_use_indexes(self):
+        host, attendee, event = self.host, self.attendee, self.event
+        calls = {
+            'EnrollmentSelector.created_by': lambda: selectors.EnrollmentSelector().created_by(attendee),
+            'EnrollmentSelector.on_event': lambda: selectors.EnrollmentSelector().on_event(event.pk, 'ACCEPTED'),
+            'EnrollmentSelector.user_on_event': lambda: selectors.EnrollmentSelector().user_on_event(
+                attendee, event.pk),
+            'EventSelector.hosted': lambda: selectors.EventSelector().hosted(host),
+            'EventSelector.enrolled': lambda: selectors.EventSelector().enrolled(attendee),
+            'EventSelector.unsettled': lambda: selectors.EventSelector().unsettled().order_by('ends_at', 'pk'),
+            'EventSelector.not_started': lambda: selectors.EventSelector().not_started(
+                selectors.EventSelector().hosted(host)),
+            'EventSelector.penalized': lambda: selectors.EventSelector().penalized(host),
+            'EventSelector.rated_by_user': lambda: selectors.EventSelector().rated_by_user(attendee),
+            'EventSelector.base_search_events': lambda: selectors.EventSelector().base_search_events(
+                attendee).order_by('starts_at'),
+            'EventSelector.events_filter_search': lambda: selectors.EventSelector().events_filter_search(
+                attendee, location_city__immutable_unaccent__trigram_similar='Sevilla'),
+            'EventSelector.text_search': lambda: selectors.EventSelector().events_filter_search(
+                attendee, 'juegos de mesa'),
+            'EventSelector.within_distance': lambda: selectors.EventSelector().within_distance(
+                models.Event.objects.all(), 5000, event.latitude, event.longitude),
+            'RatingSelector.on_user': lambda: selectors.RatingSelector().on_user(host),
+            'RatingSelector.exists_this_rating_for_this_user_and_event': lambda: selectors.RatingSelector(
+            ).exists_this_rating_for_this_user_and_event(attendee, event, host),
+            'UserSelector.event_host': lambda: selectors.UserSelector().event_host(event.pk),
+            'UserSelector.event_attendees': lambda: selectors.UserSelector().event_attendees(event.pk),
+            'UserSelector.event_enrolled': lambda: selectors.UserSelector().event_enrolled(event.pk),
+            'UserSelector.events_enrolleds': lambda: selectors.UserSelector().events_enrolleds([event]),
+            'UserSelector.events_attendees': lambda: selectors.UserSelector().events_attendees([event]),
+            'UserSelector.rated_on_event': lambda: selectors.UserSelector().rated_on_event(event.pk),
+            'UserSelector.with_token': lambda: selectors.UserSelector().with_token(attendee.profile.token),
+            'TransactionSelector.users_on_events': lambda: selectors.TransactionSelector().users_on_events(
+                [attendee], [event]),
+            'TransactionSelector.user_transactions': lambda: selectors.TransactionSelector().user_transactions(
+                attendee),
+        }
+        for name, call in calls.items():
+            with self.subTest(name):
+                self.assertNoSequentialScans(call)
+
+
+class KeysetPaginationTests(EventshowTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for day in (3, 3, 3, 5, 8, 8, 13):
+            event = models.Event.objects.get(pk=cls.event.pk)
+            event.pk = None
+            event.start_day = date.today() + timedelta(days=day)
+            event.save()
+
+    def walk(self, paginator):
+        pages, page = [], paginator.page()
+        while True:
+            pages.append([event.pk for event in page])
+            if not page.has_next():
+                break
+            page = paginator.page(after=page.next_cursor)
+
+        backwards = [[event.pk for event in page]]
+        while page.has_previous():
+            page = paginator.page(before=page.previous_cursor)
+            backwards.append([event.pk for event in page])
+        return pages, backwards[::-1]
+
+    def test_cursors_walk_every_row_once(self):
+        events = models.Event.objects.all()
+        for ordering in (('starts_at', 'pk'), ('-starts_at', '-pk'), ('-start_day', 'start_time', 'pk')):
+            with self.subTest(ordering):
+                expected = list(events.order_by(*ordering).values_list('pk', flat=True))
+                forwards, backwards = self.walk(KeysetPaginator(events, 3, ordering))
+                self.assertEqual(sum(forwards, []), expected)
+                self.assertEqual(backwards, forwards)
+
+    def test_count_is_capped(self):
+        paginator = KeysetPaginator(models.Event.objects.all(), 3, ('pk',), count_cap=5)
+        self.assertEqual(paginator.count, 5)
+        self.assertTrue(paginator.count_is_capped)
+
+    def test_tampered_cursor_starts_over(self):
+        paginator = KeysetPaginator(models.Event.objects.all(), 3, ('starts_at', 'pk'))
+        self.assertEqual(list(paginator.page(after='tampered')), list(paginator.page()))
+
+    def test_cursor_of_another_ordering_starts_over(self):
+        cursor = KeysetPaginator(models.Event.objects.all(), 3, ('starts_at', 'pk')).page().next_cursor
+        paginator = KeysetPaginator(models.Event.objects.all(), 3, ('price', 'pk'))
+        self.assertEqual(list(paginator.page(after=cursor)), list(paginator.page()))
+
+
+def haversine(origin, point):
+    (lat1, lng1), (lat2, lng2) = [(math.radians(lat), math.radians(lng)) for lat, lng in (origin, point)]
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * selectors.EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class NearbySearchTests(EventshowTestCase):
+    origin = LocalGeocoderBackend.ORIGIN
+
+    def event_at(self, north, east):
+        # north and east of the origin in meters
+        event = models.Event.objects.get(pk=self.event.pk)
+        event.pk = None
+        event.save()
+        latitude = self.origin[0] + north / selectors.METERS_PER_DEGREE
+        longitude = self.origin[1] + east / (selectors.METERS_PER_DEGREE * math.cos(math.radians(self.origin[0])))
+        models.Event.objects.filter(pk=event.pk).update(latitude=latitude, longitude=longitude)
+        return event.pk, (latitude, longitude)
+
+    def test_events_are_geocoded_with_the_local_backend(self):
+        self.assertEqual((self.event.latitude, self.event.longitude),
+                         LocalGeocoderBackend().geocode(self.event.geocoding_address))
+
+    def test_addresses_the_geocoder_can_not_place_are_looked_up_once(self):
+        event = models.Event.objects.get(pk=self.event.pk)
+        with mock.patch.object(LocalGeocoderBackend, 'geocode', return_value=None) as geocode:
+            event.location_street = 'Calle Inexistente'
+            event.save()
+            event.title = 'Noche de cartas'
+            event.save()
+            self.assertEqual(geocode.call_count, 1)
+            self.assertIsNone(models.Event.objects.get(pk=event.pk).latitude)
+
+            # loaded again without coordinates, the next save tries once more
+            event = models.Event.objects.get(pk=event.pk)
+            event.save()
+            self.assertEqual(geocode.call_count, 2)
+
+    def test_events_within_the_distance_by_proximity(self):
+        models.Event.objects.filter(pk=self.event.pk).update(latitude=None, longitude=None)
+        points = dict(self.event_at(*offset) for offset in (
+            (3000, 0), (0, -1000), (-4900, 0), (0, 5100), (-20000, 3000),
+            # inside the bounding box, outside the circle
+            (4000, 4000)))
+        expected = sorted((pk for pk, point in points.items() if haversine(self.origin, point) <= 5000),
+                          key=lambda pk: haversine(self.origin, points[pk]))
+        self.assertEqual(len(expected), 3)
+
+        events = list(selectors.EventSelector().nearby_events_distance(AnonymousUser(), 5000, *self.origin))
+        self.assertEqual([event.pk for event in events], expected)
+        for event in events:
+            self.assertAlmostEqual(event.distance, haversine(self.origin, points[event.pk]), delta=1)
+
+
+class SearchResultCacheTests(EventshowTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self):
+        response = self.client.get(reverse('list_event_filter'))
+        return response, [event.pk for event in response.context['object_list']]
+
+    def test_repeated_searches_reuse_the_results(self):
+        first, events = self.search()
+        second, cached = self.search()
+        self.assertEqual(cached, events)
+        self.assertLess(second.wsgi_request.metrics.queries, first.wsgi_request.metrics.queries)
+
+    def test_users_do_not_see_their_enrollments(self):
+        self.assertEqual(self.search()[1], [self.event.pk])
+        self.client.force_login(self.attendee)
+        self.assertEqual(self.search()[1], [])
+
+    def test_event_changes_expire_the_results_once_committed(self):
+        version = models.search_version()
+        self.event.save()
+        self.assertEqual(models.search_version(), version)
+        commit()
+        self.assertNotEqual(models.search_version(), version)
+
+    def test_category_changes_expire_the_results(self):
+        category = models.Category.objects.create(name='Cine')
+        commit()
+        version = models.search_version()
+        category.name = 'Películas'
+        category.save()
+        commit()
+        renamed = models.search_version()
+        self.assertNotEqual(renamed, version)
+        category.delete()
+        commit()
+        self.assertNotEqual(models.search_version(), renamed)
+
+
+class FacetTests(EventshowTestCase):
+
+    def test_facets_count_every_result(self):
+        facets = selectors.EventSelector().facets(models.Event.objects.all())
+        self.assertEqual(facets, {
+            'total': 1,
+            'categories': [(self.event.category_id, 'Juegos', 1)],
+            'prices': [(10, 1)],
+            'days': [(self.event.start_day, 1)],
+            'cities': [('Sevilla', 1)],
+        })
+
+    def test_search_page_links_the_facets(self):
+        response = self.client.get(reverse('list_event_filter', kwargs={'category': self.event.category_id}))
+        self.assertEqual(response.context['category'], 'Juegos')
+        self.assertContains(response, '1 resultados')
+        self.assertContains(response, reverse('list_event_filter', kwargs={
+            'location': 'Sevilla', 'category': self.event.category_id}))
+
+    def test_users_reuse_their_facets(self):
+        cache.clear()
+        self.client.force_login(self.host)
+        url = reverse('list_event_filter')
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as second:
+            self.client.get(url)
+        self.assertTrue(any('GROUPING SETS' in query['sql'] for query in first.captured_queries))
+        self.assertFalse(any('GROUPING SETS' in query['sql'] for query in second.captured_queries))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), EXPORT_MAX_ATTEMPTS=2)
+class DataExportTests(EventshowTestCase):
+
+    def render(self, err=0):
+        with mock.patch.object(services.pisa, 'pisaDocument', return_value=SimpleNamespace(err=err)):
+            return services.ExportService().render_pending()
+
+    def test_failing_exports_back_off_until_they_give_up(self):
+        export = services.ExportService().request_export(self.attendee)
+        self.assertEqual(self.render(err=1), 1)
+        export.refresh_from_db()
+        self.assertEqual((export.status, export.attempts), ('PENDING', 1))
+        # not rendered again before the backoff
+        self.assertEqual(self.render(err=1), 0)
+
+        models.DataExport.objects.filter(pk=export.pk).update(next_attempt_at=now())
+        self.assertEqual(self.render(err=1), 1)
+        export = services.ExportService().request_export(self.attendee)
+        self.assertEqual((export.status, export.attempts, export.next_attempt_at), ('FAILED', 2, None))
+        self.assertEqual(self.render(), 0)
+
+    def test_an_export_that_raises_does_not_hold_back_the_others(self):
+        broken = services.ExportService().request_export(self.attendee)
+        export = services.ExportService().request_export(self.host)
+        with mock.patch.object(services.ExportService, 'export_context',
+                               side_effect=[ValueError('bad data'), {}]):
+            self.assertEqual(self.render(), 2)
+        broken.refresh_from_db()
+        self.assertEqual((broken.status, broken.attempts, broken.file_name), ('PENDING', 1, None))
+        export.refresh_from_db()
+        self.assertEqual(export.status, 'DONE')
+
+    def test_done_exports_only_replace_the_older_ones(self):
+        older = models.DataExport.objects.create(
+            user=self.attendee, version='older', status='DONE', created_at=now() - timedelta(days=1))
+        export = services.ExportService().request_export(self.attendee)
+        newer = models.DataExport.objects.create(
+            user=self.attendee, version='newer', created_at=now() + timedelta(seconds=1),
+            next_attempt_at=now() + timedelta(minutes=1))
+
+        self.assertEqual(self.render(), 1)
+        self.assertEqual(list(models.DataExport.objects.order_by('created_at').values_list('pk', 'status')),
+                         [(export.pk, 'DONE'), (newer.pk, 'PENDING')])
+        self.assertFalse(models.DataExport.objects.filter(pk=older.pk).exists())
+
+
+class CityIndexTests(EventshowTestCase):
+
+    def setUp(self):
+        # the expiries left by setUpTestData
+        commit()
+        caches.city_index.expire_now()
+
+    def test_only_city_changes_rebuild_the_index(self):
+        services.EventService().city_index()
+        event = models.Event.objects.get(pk=self.event.pk)
+        event.title = 'Noche de cartas'
+        event.save()
+        commit()
+        with self.assertNumQueries(0):
+            self.assertEqual(list(services.EventService().city_index()), ['Sevilla'])
+
+        event.location_city = 'Écija'
+        event.save()
+        commit()
+        self.assertEqual(list(services.EventService().city_index()), ['Écija'])
+        with self.assertNumQueries(0):
+            services.EventService().city_index()
+
+        event.delete()
+        commit()
+        self.assertEqual(len(services.EventService().city_index()), 0)
+
+    def test_the_index_is_rebuilt_with_the_committed_cities(self):
+        services.EventService().city_index()
+        with db_transaction.atomic():
+            event = models.Event.objects.get(pk=self.event.pk)
+            event.location_city = 'Carmona'
+            event.save()
+            # other processes can not see Carmona yet, they must not rebuild the index now
+            self.assertEqual(list(services.EventService().city_index()), ['Sevilla'])
+        commit()
+        self.assertEqual(list(services.EventService().city_index()), ['Carmona'])
+
+    def test_autocomplete_folds_accents(self):
+        models.Event.objects.filter(pk=self.event.pk).update(location_city='Écija')
+        response = self.client.get(reverse('city_autocomplete'), {'q': 'eci'})
+        self.assertEqual(response.json(), {'cities': ['Écija']})
+
+
+class LastMessageTests(EventshowTestCase):
+
+    def setUp(self):
+        # the expiries left by setUpTestData
+        commit()
+        caches.last_message.expire_now()
+        self.client.force_login(self.attendee)
+
+    def test_home_does_not_query_the_message_again(self):
+        message = models.Message.objects.create(title='Mantenimiento', description='Esta noche')
+        commit()
+        self.assertEqual(self.client.get(reverse('home')).context['message'], message)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(reverse('home')).context['message'], message)
+        self.assertFalse([query for query in queries.captured_queries if 'events_message' in query['sql']])
+
+        message.delete()
+        commit()
+        self.assertIsNone(self.client.get(reverse('home')).context['message'])
+
+    def test_messages_expire_the_cache_once_committed(self):
+        self.client.get(reverse('home'))
+        version = cache.get(caches.last_message.key)
+        with self.assertRaises(ValueError):
+            with db_transaction.atomic():
+                models.Message.objects.create(title='Mantenimiento', description='Esta noche')
+                raise ValueError('rolled back')
+        models.Message.objects.create(title='Mantenimiento', description='Mañana')
+        self.assertEqual(cache.get(caches.last_message.key), version)
+
+        commit()
+        self.assertEqual(cache.get(caches.last_message.key), version + 1)
+        self.assertEqual(self.client.get(reverse('home')).context['message'].description, 'Mañana')
@@ -23,6 +23,7 @@ urlpatterns = [
     path('events/hosted/', views.EventHostedListView.as_view(),
          name='hosted_events'),
     path('events/filter', views.EventFilterFormView.as_view(), name='event_filter'),
+    path('events/cities', views.CityAutocompleteView.as_view(), name='city_autocomplete'),
     re_path(r'^events/(?:(?P<date>\d{4}-\d{2}-\d{2})/)?(?:(?P<location>[a-zA-Z\u00C0-\u00FF\s]*)/)?(?:(?P<start_hour>\d{2}:\d{2}:\d{2})/)?(?:min(?P<min_price>\d*.?(.\d{1,2})?)/)?(?:max(?P<max_price>\d*.?(.\d{1,2})?)/)?(?:c(?P<category>\d*)/)?$',
             views.EventFilterListView.as_view(), name='list_event_filter'),
 
@@ -59,6 +60,8 @@ urlpatterns = [
     path('profile/update', views.UserUpdateView.as_view(),
          name='update_profile'),
 
+    path('stripe/webhook', views.StripeWebhookView.as_view(), name='stripe_webhook'),
+
     path('ratings/new/host/<int:event_pk>',
          views.RateHostView.as_view(), name='create_rating_host'),
     re_path(r'^ratings/new/attendee/(?P<event_pk>\d+)?/(?P<attendee_pk>\d+)?/?$',
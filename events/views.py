@@ -5,35 +5,39 @@ import urllib
 from django.db.models import Count, Sum
 from datetime import date, datetime
 
-from io import BytesIO
 
 from django.conf import settings
 from django.contrib.auth import get_user_model, login, logout
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.decorators import login_required
+from django.db import transaction as db_transaction
 
 from django.http import HttpResponseRedirect
 from django.shortcuts import render, redirect
-from django.urls import reverse, reverse_lazy
-from django.http import HttpResponse
+from django.urls import NoReverseMatch, reverse, reverse_lazy
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.shortcuts import render, redirect, reverse
-from django.template.loader import get_template
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views import generic
+from django.views.decorators.csrf import csrf_exempt
 from django.views.defaults import page_not_found
 from django.views.generic.list import MultipleObjectMixin
-from xhtml2pdf import pisa
 
 from . import forms
 from . import models
 from . import selectors
+from .pagination import CachedKeysetPaginator, KeysetPaginationMixin
 from . import services
 from django.utils.datastructures import MultiValueDictKeyError
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
 EVENT_SUCCESS_URL = reverse_lazy('hosted_events')
+FACET_DAYS = 7
+FACET_CITIES = 8
+CITY_AUTOCOMPLETE_LIMIT = 10
 User = get_user_model()
 
 
@@ -51,7 +55,6 @@ class HomeView(generic.FormView):
 
     def render_to_response(self, context, **response_kwargs):
         context['message'] = services.MessageService().last_message()
-        context['locations'] = services.EventService().locations()
         response_kwargs.setdefault('content_type', self.content_type)
         return self.response_class(
             request=self.request,
@@ -93,14 +96,15 @@ class HomeView(generic.FormView):
 
         self.request.session['form_values'] = request
         kwargs = {key: val for key, val in kwargs.items() if val}
-        return redirect(reverse('list_event_filter', kwargs=kwargs))
+        return redirect(search_url(kwargs, data.get('search')))
 
 
 @method_decorator(login_required, name='dispatch')
-class AttendeeListView(generic.ListView):
+class AttendeeListView(KeysetPaginationMixin, generic.ListView):
     model = User
     template_name = 'attendee/list.html'
     paginate_by = 5
+    keyset = ('username', 'pk')
 
     def get(self, request, *args, **kwargs):
         event_pk = kwargs.get('pk')
@@ -117,13 +121,13 @@ class AttendeeListView(generic.ListView):
         context['event_has_started'] = event.has_started
         context['event_pk'] = event_pk
         context['event_title'] = event.title
-        context['rated_attendees'] = selectors.UserSelector(
-        ).rated_on_event(event_pk)
+        context['attendee_ratings'] = selectors.RatingSelector().by_user_on_attendees(
+            self.request.user, event_pk, context['object_list'])
         return context
 
     def get_queryset(self):
         queryset = selectors.UserSelector().event_attendees(
-            self.kwargs.get('pk')).order_by('username')
+            self.kwargs.get('pk'))
         return queryset
 
 
@@ -137,27 +141,10 @@ class AttendeePaymentView(generic.View):
                 return redirect('authorize')
             else:
                 if event.has_finished:
-                    attende_list = selectors.UserSelector().event_attendees(pk)
-                    for attendee in attende_list:
-                        transaction = models.Transaction.objects.filter(
-                            created_by=attendee, event=event).first()
-                        if transaction:
-                            is_paid_for = transaction.is_paid_for
-                            if not is_paid_for:
-                                try:
-                                    attendee_amount = transaction.actual_amount
-                                    services.PaymentService().charge_connect(
-                                        attendee_amount, transaction.customer_id, transaction.discounted_fee, transaction.recipient)
-                                    transaction.is_paid_for = True
-                                    transaction.save()
-                                    if not transaction.discount:
-                                        services.UserService().add_bonus(transaction.created_by, transaction.amount)
-                                except stripe.error.StripeError:
-                                    redirect('payment_error')
-                            else:
-                                return redirect('/')
-                        event.is_paid_for = True
-                        event.save()
+                    result = services.PayoutService().pay_event(event)
+                    # None while the settlement scheduler is paying the event out
+                    if result is not None and result[1]:
+                        return redirect('payment_error')
                     return redirect('hosted_events')
                 else:
                     return redirect('/')
@@ -171,37 +158,43 @@ class EventDetailView(generic.DetailView, MultipleObjectMixin):
     paginate_by = 3
 
     def get(self, request, *args, **kwargs):
-        if services.EventService().count(kwargs.get('pk')):
-            return super().get(self, request, *args, **kwargs)
-        else:
+        try:
+            self.object = self.get_object()
+        except Http404:
             return redirect('/')
+        return self.render_to_response(self.get_context_data(object=self.object))
+
+    def get_queryset(self):
+        return selectors.EventSelector().detail(self.request.user)
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        paginator = super().get_paginator(queryset, per_page, orphans, allow_empty_first_page, **kwargs)
+        # the host profile keeps the number of ratings it got
+        paginator.count = self.object.created_by.profile.host_rating_count
+        return paginator
 
     def get_context_data(self, **kwargs):
         user = self.request.user
         event = kwargs.get('object')
-        object_list = selectors.RatingSelector().on_user(
+        object_list = selectors.RatingSelector().on_user_with_authors(
             event.created_by)
         context = super(EventDetailView, self).get_context_data(
             object_list=object_list, **kwargs)
         duration = event.duration
 
-        event_is_full = selectors.UserSelector().event_attendees(
-            event.pk).count() >= event.capacity
+        event_is_full = event.is_full
         user_can_enroll = True
 
         price = float(event.price*100)
         fee = services.PaymentService().fee(price)
 
         if user.is_authenticated:
-            context['user_is_enrolled'] = services.EnrollmentService(
-            ).user_is_enrolled(event.pk, user)
-            context['user_is_old_enough'] = services.EnrollmentService(
-            ).user_is_old_enough(event.pk, user)
-            context['user_is_owner'] = services.EventService(
-            ).user_is_owner(user, event.pk)
+            context['user_is_enrolled'] = event.user_enrollment_status is not None
+            context['user_is_old_enough'] = event.min_age <= user.profile.age
+            context['user_is_owner'] = event.created_by_id == user.pk
 
             context['have_creditcard'] = services.PaymentService(
-            ).is_customer(user.email)
+            ).is_customer(user)
 
             user_can_enroll = not context.get('user_is_enrolled') and context.get(
                 'user_is_old_enough') and not context.get('user_is_owner')
@@ -220,8 +213,7 @@ class EventDetailView(generic.DetailView, MultipleObjectMixin):
         context['stripe_key'] = settings.STRIPE_PUBLISHABLE_KEY
         context['event_is_full'] = event_is_full
 
-        context['attendees'] = selectors.EnrollmentSelector().on_event(
-            event.pk, 'ACCEPTED').count()
+        context['attendees'] = event.accepted_count
         context['user_can_enroll'] = not event_is_full and user_can_enroll
         context['fee'] = fee/100
 
@@ -268,7 +260,7 @@ class EventDeleteView(generic.DeleteView):
         if services.EventService().count(event_pk):
             event = models.Event.objects.get(pk=event_pk)
 
-            attendees = selectors.UserSelector().event_attendees(event_pk).count()
+            attendees = event.accepted_count
             amount_host = services.PaymentService().fee(round(event.price*100))
             context['penalty'] = (amount_host*attendees)
             context['attendees_count'] = attendees
@@ -283,8 +275,8 @@ class EventDeleteView(generic.DeleteView):
             event = models.Event.objects.get(pk=event_pk)
             attendees = selectors.UserSelector().event_attendees(event_pk)
 
-            if not event.can_delete:
-                penalty(event, request.POST.get('stripeToken'))
+            if not event.can_delete and not penalty(event, request.POST.get('stripeToken')):
+                return redirect('payment_error')
 
             if not event.has_started:
                 enrolled_users = selectors.UserSelector().event_enrolled(event)
@@ -296,9 +288,10 @@ class EventDeleteView(generic.DeleteView):
             recipient_list_queryset = attendees
             recipient_list = list(
                 recipient_list_queryset.values_list('email', flat=True))
-            #services.EmailService().send_email(subject, body, recipient_list)
 
-            self.object.delete()
+            with db_transaction.atomic():
+                services.EmailService().send_email(subject, body, recipient_list)
+                self.object.delete()
             return redirect('hosted_events')
         else:
             return redirect('/')
@@ -314,10 +307,11 @@ class EventDeleteView(generic.DeleteView):
 
 
 @method_decorator(login_required, name='dispatch')
-class EventHostedListView(generic.ListView):
+class EventHostedListView(KeysetPaginationMixin, generic.ListView):
     model = models.Event
     template_name = 'event/list.html'
     paginate_by = 5
+    keyset = ('starts_at', 'pk')
 
     def get_context_data(self, **kwargs):
         context = super(EventHostedListView, self).get_context_data(**kwargs)
@@ -326,26 +320,27 @@ class EventHostedListView(generic.ListView):
 
     def get_queryset(self):
         queryset = selectors.EventSelector().hosted(
-            self.request.user).order_by('start_day')
+            self.request.user)
         return queryset
 
 
 @method_decorator(login_required, name='dispatch')
-class EventEnrolledListView(generic.ListView):
+class EventEnrolledListView(KeysetPaginationMixin, generic.ListView):
     model = models.Enrollment
     template_name = 'event/list.html'
     paginate_by = 5
+    keyset = ('event__starts_at', 'pk')
 
     def get_context_data(self, **kwargs):
         context = super(EventEnrolledListView, self).get_context_data(**kwargs)
-        context['user_rated_events'] = selectors.EventSelector().rated_by_user(
-            self.request.user)
+        context['user_ratings'] = selectors.RatingSelector().by_user_on_events(
+            self.request.user, [enrollment.event_id for enrollment in context['object_list']])
         context['role'] = 'huésped'
         return context
 
     def get_queryset(self):
         queryset = selectors.EnrollmentSelector().created_by(
-            self.request.user).order_by('event__start_day')
+            self.request.user).select_related('event__created_by')
         return queryset
 
 
@@ -369,9 +364,13 @@ class EventUpdateView(generic.UpdateView):
             recipient_list_queryset = selectors.UserSelector().event_attendees(event_pk)
             recipient_list = list(
                 recipient_list_queryset.values_list('email', flat=True))
-            #services.EmailService().send_email(subject, body, recipient_list)
-            services.EventService().update(event, host)
-            return super(EventUpdateView, self).form_valid(form)
+
+            with db_transaction.atomic():
+                services.EmailService().send_email(subject, body, recipient_list)
+                services.EventService().update(event, host)
+            # form_valid would save the whole event again
+            self.object = event
+            return redirect(self.get_success_url())
 
         else:
             return redirect('events')
@@ -409,35 +408,81 @@ class EventFilterFormView(generic.FormView):
                 del self.request.session['latitude']
                 del self.request.session['longitude']
 
-        return redirect(reverse('list_event_filter', kwargs=kwargs))
+        return redirect(search_url(kwargs, data.get('search')))
 
     def form_invalid(self, form):
         self.request.session['form_values'] = self.request.POST
         return redirect('list_event_filter')
 
 
-class EventFilterListView(generic.ListView):
+class CityAutocompleteView(generic.View):
+
+    def get(self, request, *args, **kwargs):
+        cities = services.EventService().city_index().complete(request.GET.get('q', ''), CITY_AUTOCOMPLETE_LIMIT)
+        return JsonResponse({'cities': cities})
+
+
+class EventFilterListView(KeysetPaginationMixin, generic.ListView):
     model = models.Event
     template_name = 'event/list_search.html'
     paginate_by = 12
     form_class = forms.SearchFilterForm
 
+    def get_keyset(self):
+        if self.request.session.get('latitude') and self.request.session.get('longitude'):
+            return ('distance', 'pk')
+        if self.request.GET.get('q'):
+            return ('-rank', 'starts_at', 'pk')
+        return ('starts_at', 'pk')
+
     def get_context_data(self, **kwargs):
         context = super(EventFilterListView,
                         self).get_context_data(**kwargs)
-        context['locations'] = services.EventService().locations()
-        context['location'] = self.kwargs.get('location_city__icontains', None)
-        context['category'] = models.Category.objects.filter(
-            pk=self.kwargs.get('category')).values_list('name', flat=True).first()
+        facets = context['paginator'].results.facets(self.object_list, context['paginator'].shared)
+        context['location'] = self.filters.get('location')
+        context['category'] = next((name for category, name, total in facets['categories']
+                                    if str(category) == self.filters.get('category')), None)
         context['form'] = self.form_class(
             self.request.session.get('form_values'))
-        context['categories'] = context.get('paginator').object_list.values(
-            'category__name', 'category').annotate(total=Count('category')).order_by('total')
+        context['search'] = self.request.GET.get('q')
+        context['facets'] = self.facet_links(facets, context['search'])
         return context
 
+    def facet_links(self, facets, search):
+        def link(label, total, **filters):
+            try:
+                return {'label': label, 'total': total, 'url': search_url(dict(self.filters, **filters), search)}
+            except NoReverseMatch:
+                # cities with characters the url does not accept
+                return None
+
+        prices = []
+        for bound, total in facets['prices']:
+            if bound == 0:
+                prices.append(link('Gratis', total, max_price='0'))
+            elif bound is None:
+                # prices have two decimals at most
+                prices.append(link('Más de {0} €'.format(selectors.PRICE_FACETS[-1]), total,
+                                   min_price='{0}.01'.format(selectors.PRICE_FACETS[-1])))
+            else:
+                previous = selectors.PRICE_FACETS[selectors.PRICE_FACETS.index(bound) - 1]
+                prices.append(link('De {0} a {1} €'.format(previous, bound), total,
+                                   min_price='{0}.01'.format(previous), max_price=str(bound)))
+
+        facets = [
+            ('Categorías', [link(name, total, category=str(category))
+                            for category, name, total in facets['categories']]),
+            ('Precio', prices),
+            ('Fecha', [link(day.strftime('%d/%m/%Y'), total, date=day.isoformat())
+                       for day, total in facets['days'][:FACET_DAYS]]),
+            ('Localización', [link(city, total, location=city) for city, total in facets['cities'][:FACET_CITIES]]),
+        ]
+        return [(title, [facet for facet in links if facet]) for title, links in facets]
+
     def get_queryset(self):
+        self.filters = {key: val for key, val in self.kwargs.items() if val}
         self.kwargs['start_day'] = self.kwargs.pop('date', None) or None
-        self.kwargs['location_city__unaccent__trigram_similar'] = self.kwargs.pop(
+        self.kwargs['location_city__immutable_unaccent__trigram_similar'] = self.kwargs.pop(
             'location', None) or None
         self.kwargs['start_time__gte'] = self.kwargs.pop(
             'start_hour', None) or None
@@ -447,17 +492,28 @@ class EventFilterListView(generic.ListView):
             'max_price', None) or None
         self.kwargs['category'] = self.kwargs.pop('category', None) or None
 
+        return self.search_events(self.request.user)
+
+    def search_events(self, user):
         latitude = self.request.session.get('latitude')
         longitude = self.request.session.get('longitude')
+        search = self.request.GET.get('q')
 
         if not (latitude and longitude):
             queryset = selectors.EventSelector().events_filter_search(
-                self.request.user, **self.kwargs).order_by('start_day')
+                user, search, **self.kwargs)
         else:
             queryset = selectors.EventSelector().nearby_events_distance(
-                self.request.user, 5000, self.request.session.get('latitude'), self.request.session.get('longitude'), **self.kwargs)
+                user, 5000, latitude, longitude, search, **self.kwargs)
 
-        return queryset
+        return queryset.select_related('category', 'created_by__profile')
+
+    def get_keyset_paginator(self, queryset, page_size):
+        results = selectors.SearchResultCache(
+            self.request.user, self.request.GET.get('q'), latitude=self.request.session.get('latitude'),
+            longitude=self.request.session.get('longitude'), **self.kwargs)
+        return CachedKeysetPaginator(queryset, page_size, self.get_keyset(), results,
+                                     self.search_events(AnonymousUser()))
 
 
 @method_decorator(login_required, name='dispatch')
@@ -472,56 +528,43 @@ class EnrollmentCreateView(generic.View):
 
     def post(self, request, *args, **kwargs):
         attendee = self.request.user
-        event_pk = kwargs.get('pk')
-        event = models.Event.objects.get(pk=event_pk)
-        event_exists = services.EventService().count(event_pk)
-        event_is_full = selectors.UserSelector().event_attendees(
-            event_pk).count() >= event.capacity
-        event_has_started = event.has_started
-        user_can_enroll = services.EnrollmentService().user_can_enroll(
-            event_pk, attendee)
-
-        context = {'event_title': models.Event.objects.get(pk=event_pk)}
-
-        if event_exists and user_can_enroll and not event_is_full and not event_has_started:
-            enrollment = services.EnrollmentService().create(event_pk, attendee)
+        # asks Stripe before the event row is locked by the admission
+        customer_id = services.PaymentService().get_or_create_customer(
+            attendee, request.POST.get('stripeToken'))
+
+        fee = request.session.get('fee')
+        if request.POST.get('discounted', None):
+            discount = request.session.get(
+                'fee') - request.session.get('discounted_fee')
+        else:
+            discount = 0
 
-            event = models.Event.objects.get(pk=event_pk)
-            if not services.PaymentService().is_customer(attendee.email):
-                customer = services.PaymentService().get_or_create_customer(
-                    request.user.email, request.POST['stripeToken'])
-            else:
-                customer = services.PaymentService().get_or_create_customer(request.user.email, None)
+        # the enrollment, its payment and the email to the host are committed together
+        with db_transaction.atomic():
+            admission, enrollment = services.EnrollmentService().admit(
+                kwargs.get('pk'), attendee)
+            if admission != services.Admission.ADMITTED:
+                return redirect('/')
 
-            fee = request.session.get('fee')
-            if request.POST.get('discounted', None):
-                discount = request.session.get(
-                    'fee') - request.session.get('discounted_fee')
+            event = enrollment.event
+            event_transaction = services.PaymentService().save_transaction(
+                int(event.price*100), fee, customer_id, event, attendee, event.created_by, discount)
+            if discount:
                 eventpoints = int(
                     round(discount/settings.EVENTPOINT_VALUE/settings.STRIPE_VARIABLE_FEE))
-                updated_eventpoints = attendee.profile.eventpoints - \
-                    max(0, eventpoints)
-                attendee.profile.eventpoints = max(0, updated_eventpoints)
-                attendee.profile.save()
-            else:
-                discount = 0
-
-            services.PaymentService().save_transaction(
-                int(event.price*100), fee, customer.id, event, attendee, event.created_by, discount)
-
-            del request.session['discounted_fee']
-            del request.session['fee']
+                services.EventpointsService().debit(attendee, eventpoints, 'DISCOUNT', event_transaction)
 
             subject = 'Nueva inscripción a {0}'.format(event.title)
             body = 'El usuario {0} se ha inscrito a tu evento {1} en Eventshow'.format(
                 enrollment.created_by.username, event.title)
             recipient = event.created_by.email
+            services.EmailService().send_email(subject, body, [recipient])
 
-            #services.EmailService().send_email(subject, body, [recipient])
+        del request.session['discounted_fee']
+        del request.session['fee']
 
-            return render(request, 'enrollment/thanks.html', context)
-        else:
-            return redirect('/')
+        context = {'event_title': event}
+        return render(request, 'enrollment/thanks.html', context)
 
 
 class EnrollmentDeleteView(generic.View):
@@ -534,15 +577,16 @@ class EnrollmentDeleteView(generic.View):
         event = enrollment.event
         if enrollment and not event.has_started:
             user = self.request.user
-            if (enrollment.is_accepted and (event.start_day - date.today()).days > 3) or not enrollment.is_accepted:
-                services.UserService().return_eventpoints(user, event)
-            enrollment.delete()
-
             subject = 'Asistencia a {0} cancelada'.format(event.title)
             body = 'El usuario {0} ha cancelado su asistencia a tu evento {1} en Eventshow'.format(
                 user.username, event.title)
             recipient = event.created_by.email
-            #services.EmailService().send_email(subject, body, [recipient])
+
+            with db_transaction.atomic():
+                if (enrollment.is_accepted and (event.start_day - date.today()).days > 3) or not enrollment.is_accepted:
+                    services.UserService().return_eventpoints(user, event)
+                enrollment.delete()
+                services.EmailService().send_email(subject, body, [recipient])
 
             return redirect('enrolled_events')
         else:
@@ -579,26 +623,21 @@ class EnrollmentUpdateView(generic.View):
 
         if services.EnrollmentService().count(enrollment_pk) and self.updatable(host) and (
                 status == 'ACCEPTED' or status == 'REJECTED'):
-            services.EnrollmentService().update(
-                enrollment_pk, host, status)
             enrollment = models.Enrollment.objects.get(pk=enrollment_pk)
             event = enrollment.event
-
-            if status == 'ACCEPTED':
-                status_txt = 'aceptada'
-            else:
-                attendee = enrollment.created_by
-                services.UserService().return_eventpoints(attendee, event)
-                status_txt = 'rechazada'
-
+            attendee = enrollment.created_by
+            status_txt = 'aceptada' if status == 'ACCEPTED' else 'rechazada'
             subject = 'Solicitud para {0} {1}'.format(event.title, status_txt)
             body = 'Tu solicitud en Eventshow para el evento {0} ha sido {1}'.format(
                 event.title, status_txt)
-            recipient = models.Enrollment.objects.get(
-                pk=enrollment_pk).created_by
 
-            # services.EmailService().send_email(
-            # subject, body, [recipient.email])
+            with db_transaction.atomic():
+                if not services.EnrollmentService().update(enrollment_pk, host, status):
+                    return redirect('list_enrollments', event.pk)
+                if status == 'REJECTED':
+                    services.UserService().return_eventpoints(attendee, event)
+                services.EmailService().send_email(
+                    subject, body, [attendee.email])
 
             return redirect('list_enrollments', event.pk)
         else:
@@ -771,6 +810,18 @@ class SignUpView(generic.CreateView):
         return super(SignUpView, self).form_valid(form)
 
 
+@method_decorator(csrf_exempt, name='dispatch')
+class StripeWebhookView(generic.View):
+
+    def post(self, request, *args, **kwargs):
+        try:
+            services.StripeEventService().receive(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''))
+        except (ValueError, stripe.error.SignatureVerificationError):
+            return HttpResponse(status=400)
+        # processed later by the process_stripe_events command
+        return HttpResponse()
+
+
 @method_decorator(login_required, name='dispatch')
 class StripeAuthorizeCallbackView(generic.View):
 
@@ -789,13 +840,9 @@ class StripeAuthorizeCallbackView(generic.View):
             stripe_user_id = resp.json()['stripe_user_id']
             stripe_access_token = resp.json()['access_token']
             usuario = request.session['usuario']
-            user = User.objects.filter(pk=usuario).first()
-
-            profile = user.profile
-            profile.stripe_access_token = stripe_access_token
-            profile.stripe_user_id = stripe_user_id
-            profile.save()
-            user.save()
+            # the balance and rating counters of the profile are left as they are in the database
+            models.Profile.objects.filter(user=usuario).update(
+                stripe_access_token=stripe_access_token, stripe_user_id=stripe_user_id)
         url = reverse('hosted_events')
         response = redirect(url)
         return response
@@ -821,14 +868,15 @@ class StripeAuthorizeView(generic.View):
 
 
 @method_decorator(login_required, name='dispatch')
-class TransactionListView(generic.ListView):
+class TransactionListView(KeysetPaginationMixin, generic.ListView):
     model = models.Transaction
     template_name = 'profile/receipts.html'
     paginate_by = 5
+    keyset = ('-created_at', '-pk')
 
     def get_queryset(self):
         queryset = selectors.TransactionSelector().user_transactions(
-            self.request.user).order_by('-created_at')
+            self.request.user)
         return queryset
 
 
@@ -928,55 +976,28 @@ class UserUpdateView(generic.UpdateView):
 @method_decorator(login_required, name='dispatch')
 class DownloadPDF(View):
 
-    def render_to_pdf(self, template_src, context_dict={}):
-        template = get_template(template_src)
-        html = template.render(context_dict)
-        result = BytesIO()
-        pdf = pisa.pisaDocument(BytesIO(html.encode("ISO-8859-1")), result)
-        if not pdf.err:
-            return HttpResponse(result.getvalue(), content_type='application/pdf')
-        return None
-
     def get(self, request, *args, **kwargs):
         user = request.user
-        profile = user.profile
-        events = selectors.EventSelector().hosted(user)
-        enrollments = models.Enrollment.objects.filter(created_by=user)
-        ratings = models.Rating.objects.filter(created_by=user)
-        transactions = models.Transaction.objects.filter(created_by=user)
-        data = {
-            "name": user.first_name,
-            "last_name": user.last_name,
-            "email": user.email,
-            "date_join": user.date_joined,
-            "location": profile.location,
-
-            "picture": profile.picture,
-            "birthdate": profile.birthdate,
-            "token": profile.token,
-            "eventpoints": profile.eventpoints,
-            "bio": profile.bio,
-            "events": events,
-            "enrollments": enrollments,
-            "ratings": ratings,
-            "transactions": transactions,
+        export = services.ExportService().request_export(user)
+        if export.is_done:
+            return FileResponse(services.ExportService().open(export), as_attachment=True,
+                                filename=user.username + '-eventshow.pdf', content_type='application/pdf')
+        return render(request, 'profile/pdf_pending.html', {'export': export})
 
-        }
-        pdf = self.render_to_pdf('profile/pdf.html', data)
 
-        response = HttpResponse(pdf, content_type='application/pdf')
-        filename = user.username+'-eventshow.pdf'
-        content = "attachment; filename=%s" % (filename)
-        response['Content-Disposition'] = content
-        return response
+def search_url(kwargs, search=None):
+    url = reverse('list_event_filter', kwargs=kwargs)
+    if search:
+        url += '?' + urllib.parse.urlencode({'q': search})
+    return url
 
 
-def penalty(event, stripe_token):
+def penalty(event, stripe_token) -> bool:
     try:
-        attendees = selectors.UserSelector().event_attendees(event.pk).count()
+        attendees = event.accepted_count
         fee = services.PaymentService().fee(round(event.price*100))
         services.PaymentService().charge(
             round(fee*attendees), stripe_token)
-
+        return True
     except stripe.error.StripeError:
-        redirect('payment_error')
+        return False
@@ -31,9 +31,13 @@ STRIPE_CONNECT_CLIENT_ID = os.environ.get('STRIPE_CONNECT_CLIENT_ID', '')
 STRIPE_REQUEST_URI = os.environ.get('STRIPE_REQUEST_URI', '')
 STRIPE_CONST_FEE = 25
 STRIPE_VARIABLE_FEE = 1.029
+STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+PAYOUT_MAX_WORKERS = 8
 
 # Google Maps
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY', '')
+GEOCODER_BACKEND = 'events.backends.GoogleGeocoderBackend'
 
 EVENTPOINT_VALUE = 0.5
 EVENTPOINT_BONUS = 0.05
@@ -61,6 +65,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'events.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -121,6 +126,10 @@ LOGGING = {
         'testlogger': {
             'handlers': ['console'],
             'level': 'INFO',
+        },
+        'events.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
         }
     }
 }
@@ -189,6 +198,7 @@ EMAIL_HOST = os.environ.get('MAILGUN_SMTP_SERVER', '')
 EMAIL_PORT = os.environ.get('MAILGUN_SMTP_PORT', '')
 EMAIL_HOST_USER = os.environ.get('MAILGUN_SMTP_LOGIN', '')
 EMAIL_HOST_PASSWORD = os.environ.get('MAILGUN_SMTP_PASSWORD', '')
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
@@ -203,6 +213,22 @@ AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
 AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME', '')
 AWS_DEFAULT_ACL = None
 DEFAULT_FILE_STORAGE = 'events.backends.MediaStorageBackend'
+EXPORT_FILE_STORAGE = 'events.backends.PrivateMediaStorageBackend'
+EXPORT_MAX_ATTEMPTS = 3
+
+# shared by every dyno, REDIS_URL is set by the Heroku Redis add-on. The cache versions are bumped with
+# an atomic INCR and no cached read costs a query to the database
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    }
+}
+# seconds that search results are shared between visitors
+SEARCH_CACHE_TIMEOUT = 60
 
 
 STATICFILES_DIRS = (
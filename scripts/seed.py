@@ -3,21 +3,27 @@ import json
 import os
 import random
 import re
+import uuid
 
 
 from random import randrange
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.hashers import make_password
 from django.core import management
+from django.core.cache import cache
+from django.core.management.color import no_style
+from django.db import connection
 from django.utils.crypto import get_random_string
-from django.utils.timezone import now
+from django.utils.timezone import make_aware, now
 from faker import Faker
 
+from events import models
+from events.backends import LocalGeocoderBackend
 from events.models import Category
-from events.services import PaymentService
+from events.services import EventpointsService, PaymentService, RatingService
 
 User = get_user_model()
 
@@ -38,8 +44,15 @@ USER_PKS = range(1, 31)
 TIMEZONE = '+0000'
 
 
-def run():
+def run(*args):
+    if args:
+        # runscript seed --script-args users=100000 events=1000000 seed=42 ...
+        return seed_large(**{key: value if key == 'today' else int(value)
+                             for key, value in (arg.split('=') for arg in args)})
+
     management.call_command('flush', interactive=False)
+    # the cached search results and cities belong to the flushed rows
+    cache.clear()
 
     seed_users()
     seed_profiles()
@@ -51,6 +64,9 @@ def run():
         file.write(json.dumps(INITIAL_DATA, indent=4))
 
     management.call_command('loaddata', 'initial_data/initial_data')
+    # the fixture does not go through the services, the profile counters and ledgers are computed afterwards
+    RatingService().rebuild_scores()
+    EventpointsService().open_ledgers()
 
 
 def seed_users():
@@ -156,15 +172,7 @@ def seed_events(event_pks, future=False):
         aux.remove(host)
         enrollers = random.sample(set(aux), k=FAKE.random_int(1, len(aux)))
 
-        address = random.choice(addresses)
-        city = address['localidad']
-        residence = address['domicilio']
-        street = re.match(
-            r'[a-zA-ZÀ-ÖØ-öø-ÿ/]+\.?(( |\-)[a-zA-ZÀ-ÖØ-öø-ÿ]+\.?)*',
-            residence).group()
-        # finds all digits in string and take the first which is the street number
-        aux = [int(s) for s in residence.split() if s.isdigit()]
-        number = aux[0] if aux else 0
+        city, street, number = parse_address(random.choice(addresses))
         price = FAKE.random_int(5, 20)
 
         min_start_time = datetime.strptime('09:00', '%H:%M')
@@ -230,6 +238,17 @@ def generate_addresses():
     return data
 
 
+def parse_address(address):
+    residence = address['domicilio']
+    street = re.match(
+        r'[a-zA-ZÀ-ÖØ-öø-ÿ/]+\.?(( |\-)[a-zA-ZÀ-ÖØ-öø-ÿ]+\.?)*',
+        residence).group()
+    # finds all digits in string and take the first which is the street number
+    aux = [int(s) for s in residence.split() if s.isdigit()]
+    number = aux[0] if aux else 0
+    return address['localidad'], street, number
+
+
 def seed_event_enrollments(event, enrollers, host, event_date, price, capacity, is_paid):
     created_at = FAKE.date_time_between(
         start_date='-1y', end_date=event_date)
@@ -351,3 +370,185 @@ def random_time(start, end):
     int_delta = delta.seconds
     random_second = randrange(int_delta)
     return start + timedelta(seconds=random_second)
+
+
+LARGE_DEFAULTS = {
+    'users': 1000,
+    'events': 10000,
+    'enrollments': 50000,
+    'ratings': 10000,
+    'transactions': 30000,
+    'seed': 0,
+    'batch': 5000,
+    # the date the events are spread around, today unless given as YYYY-MM-DD
+    'today': None,
+}
+# faker is far too slow to call per row at this size, rows pick from pools generated once
+POOL_SIZE = 1000
+
+
+def seed_large(**options):
+    options = dict(LARGE_DEFAULTS, **options)
+    options['today'] = date.fromisoformat(options['today']) if options['today'] else now().date()
+    random.seed(options['seed'])
+    FAKE.seed_instance(options['seed'])
+
+    management.call_command('flush', interactive=False)
+    cache.clear()
+    models.Category.objects.bulk_create(
+        [models.Category(pk=ix, name=name) for ix, name in enumerate(CATEGORIES)])
+
+    writer = BatchWriter(options['batch'])
+    seed_large_users(writer, options['users'], options['today'])
+    seed_large_events(writer, options)
+    writer.flush()
+
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [
+                User, models.Profile, models.Category, models.Event, models.Enrollment, models.Rating]):
+            cursor.execute(sql)
+    RatingService().rebuild_scores()
+    EventpointsService().open_ledgers()
+
+    for model, count in writer.counts.items():
+        print('{0}: {1} rows'.format(model.__name__, count))
+
+
+class BatchWriter:
+    # parents are written before their children on every flush
+    MODELS = [User, models.Profile, models.Event,
+              models.Enrollment, models.Transaction, models.Rating]
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.rows = {model: [] for model in self.MODELS}
+        self.counts = {model: 0 for model in self.MODELS}
+
+    def add(self, instance):
+        rows = self.rows[type(instance)]
+        rows.append(instance)
+        if len(rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for model, rows in self.rows.items():
+            model.objects.bulk_create(rows, batch_size=self.batch_size)
+            self.counts[model] += len(rows)
+            rows.clear()
+
+
+def seed_large_users(writer, users, today):
+    # hashing one password per user would take hours, every seeded user logs in with 'eventshow'
+    password = make_password('eventshow')
+    profiles = [FAKE.profile(fields=['username', 'name', 'mail']) for _ in range(POOL_SIZE)]
+    bios = [FAKE.text() for _ in range(POOL_SIZE)]
+    cities = [FAKE.city() for _ in range(POOL_SIZE)]
+    joined = make_aware(datetime.combine(today, datetime.min.time())) - timedelta(days=365)
+
+    for pk in range(1, users + 2):
+        superuser = pk == users + 1
+        profile = random.choice(profiles)
+        names = profile['name'].split(' ')
+        writer.add(User(
+            pk=pk, password=make_password('showman') if superuser else password,
+            username='showman' if superuser else '{0}{1}'.format(profile['username'], pk),
+            first_name=names[0], last_name=names[1], email='{0}{1}'.format(pk, profile['mail']),
+            is_superuser=superuser, is_staff=superuser, date_joined=joined))
+        writer.add(models.Profile(
+            pk=pk, user_id=pk, location=random.choice(cities),
+            picture='seed/profile/' + random.choice(PROFILE_IMAGE_FILES),
+            birthdate=FAKE.date_between(start_date='-60y', end_date='-18y'),
+            eventpoints=0 if superuser else random.randint(1, 250),
+            token=''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(8)),
+            bio=random.choice(bios)))
+
+
+def seed_large_events(writer, options):
+    users = options['users']
+    events = options['events']
+    geocoder = LocalGeocoderBackend()
+    addresses = []
+    for address in generate_addresses():
+        city, street, number = parse_address(address)
+        addresses.append((city, street, number, geocoder.geocode(
+            '{0} {1}, {2}'.format(number, street, city))))
+    titles = [FAKE.word() for _ in range(POOL_SIZE)]
+    texts = [FAKE.text() for _ in range(POOL_SIZE)]
+    sentences = [FAKE.sentence() for _ in range(POOL_SIZE)]
+    today = options['today']
+
+    # per row rates that land close to the requested totals, capacity permitting
+    enrollments_per_event = min(options['enrollments'] / max(events, 1), users - 1)
+    transaction_rate = min(1, options['transactions'] / max(options['enrollments'] * 2 / 3, 1))
+    rating_rate = min(1, options['ratings'] / max(options['enrollments'] / 3, 1))
+
+    for pk in range(1, events + 1):
+        # half of the events already happened during the last year, the rest within two years
+        start_day = today + timedelta(days=random.randint(-365, -1) if pk % 2 else random.randint(0, 730))
+        city, street, number, (latitude, longitude) = random.choice(addresses)
+        host = random.randint(1, users)
+        capacity = random.randint(2, 20)
+        price = random.randint(5, 20)
+        is_paid = start_day < today and random.choice([True, False])
+        start_time = random_time(datetime.strptime('09:00', '%H:%M'), datetime.strptime('15:00', '%H:%M'))
+        end_time = random_time(datetime.strptime('16:00', '%H:%M'), datetime.strptime('22:00', '%H:%M'))
+
+        enrollers = random.sample(range(1, users + 1), k=min(
+            users, random.randint(0, round(2 * enrollments_per_event))))
+        enrollers = [enroller for enroller in enrollers if enroller != host]
+        accepted, rows = seed_large_enrollments(
+            pk, host, enrollers, start_day, capacity, price, is_paid, transaction_rate, rating_rate, sentences, today)
+
+        created_at = make_aware(datetime.combine(start_day, datetime.min.time())) - timedelta(
+            days=random.randint(1, 365))
+        event = models.Event(
+            pk=pk, created_at=created_at, updated_at=created_at, title=random.choice(titles), description=random.choice(texts),
+            picture='seed/event/' + random.choice(EVENT_IMAGE_FILES),
+            location_city=city, location_street=street, location_number=number,
+            latitude=latitude, longitude=longitude,
+            start_day=start_day, start_time=start_time.time(), end_time=end_time.time(),
+            price=price, capacity=capacity, min_age=random.randint(16, 25), lang='español',
+            pets=random.choice([False, True]), parking_nearby=random.choice([False, True]),
+            extra_info=random.choice(sentences), is_paid_for=is_paid, accepted_count=accepted,
+            created_by_id=host, category_id=random.randrange(len(CATEGORIES)))
+        # bulk_create skips the signal that keeps them
+        event.starts_at, event.ends_at = event.timestamps()
+        writer.add(event)
+        for row in rows:
+            writer.add(row)
+
+
+def seed_large_enrollments(event, host, enrollers, event_date, capacity, price, is_paid,
+                           transaction_rate, rating_rate, comments, today):
+    fee = PaymentService().fee(price * 100)
+    event_datetime = make_aware(datetime.combine(event_date, datetime.min.time()))
+    accepted = 0
+    rows = []
+
+    for enroller in enrollers:
+        status = random.choice(ENROLLMENT_STATUS)
+        if status == 'ACCEPTED' and accepted == capacity:
+            status = 'PENDING'
+        created_at = event_datetime - timedelta(days=random.randint(1, 365))
+        rows.append(models.Enrollment(
+            status=status, created_at=created_at, updated_at=created_at,
+            created_by_id=enroller, event_id=event))
+
+        if status != 'REJECTED' and random.random() < transaction_rate:
+            rows.append(models.Transaction(
+                id=uuid.UUID(int=random.getrandbits(128)), amount=price * 100,
+                discount=round(fee * 0.15), fee=fee, created_at=created_at, updated_at=created_at,
+                event_id=event, created_by_id=enroller, recipient_id=host,
+                customer_id='cus_{0:014x}'.format(random.getrandbits(56)), is_paid_for=is_paid))
+
+        if status == 'ACCEPTED':
+            accepted += 1
+            if event_date < today:
+                rated_at = event_datetime + timedelta(days=random.randint(1, 30))
+                for on, reviewer, reviewed in (('HOST', enroller, host), ('ATTENDEE', host, enroller)):
+                    if random.random() < rating_rate:
+                        rows.append(models.Rating(
+                            score=random.randint(1, 5), comment=random.choice(comments),
+                            event_id=event, on=on, created_at=rated_at, updated_at=rated_at,
+                            created_by_id=reviewer, reviewed_id=reviewed))
+    return accepted, rows